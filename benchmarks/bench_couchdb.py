@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the ``relax.couchdb`` specifier helpers and shortcuts.
+
+The shortcuts are run against a ``FakeCouchServer`` in this process, so they
+measure the client side (and the local HTTP round trip) only.
+"""
+
+import itertools
+
+from relax import couchdb as relax_couchdb
+from relax.couchdb import doccache, shortcuts
+
+from benchmarks import corpus
+from benchmarks.fakecouch import FakeCouchServer
+
+
+SPECIFIERS = ['local:db_%d' % (i,) for i in xrange(50)] + [
+    'remote:couch%d.example.com:5984:db_%d' % (i, i) for i in xrange(50)]
+DB_STRINGS = ['db_%d' % (i,) for i in xrange(50)] + [
+    'http://couch%d.example.com:5984/db_%d' % (i, i) for i in xrange(50)]
+
+_server = None
+
+def get_server():
+    """Return the (started) fake CouchDB server, with a populated database."""
+    global _server
+    if _server is None:
+        _server = FakeCouchServer()
+        _server.start()
+        _server.dbs['bench'] = dict((doc['_id'], doc)
+            for doc in corpus.make_corpus(1000, 'medium'))
+    return _server
+
+def stop_server():
+    """Close the client connections and stop the fake CouchDB server."""
+    global _server
+    if _server is not None:
+        # Closing the connections lets the server's handler threads finish.
+        connections = getattr(doccache.cache.local, 'connections', {})
+        for connection in connections.values():
+            connection.close()
+        connections.clear()
+        shortcuts.pool.clear()
+        _server.shutdown()
+        _server.server_close()
+        _server = None
+
+def call_benchmark(function, args, count, batch_size=1000):
+    """Time ``count`` calls of a function, cycling through some arguments."""
+    def benchmark(timer, scale):
+        cycle = itertools.cycle(args)
+        def batch(size):
+            for i in xrange(size):
+                function(cycle.next())
+        remaining = int(count * scale)
+        while remaining > 0:
+            size = min(batch_size, remaining)
+            timer.time(batch, size, size)
+            remaining -= size
+    return benchmark
+
+def doc_ids():
+    return sorted(get_server().dbs['bench'])
+
+def get_doc_benchmark(get_doc, count=2000):
+    def benchmark(timer, scale):
+        server_url = get_server().url
+        ids = itertools.cycle(doc_ids())
+        for i in xrange(int(count * scale)):
+            timer.time(get_doc, 1, ids.next(), 'bench', server_url)
+    return benchmark
+
+def get_docs_benchmark(count=20, chunk=1000):
+    def benchmark(timer, scale):
+        server_url = get_server().url
+        ids = doc_ids()[:chunk]
+        for i in xrange(int(count * scale)):
+            timer.time(lambda: list(shortcuts.get_docs(ids, 'bench',
+                server_url)), len(ids))
+    return benchmark
+
+def save_docs_benchmark(count=20, chunk=500):
+    def benchmark(timer, scale):
+        server = get_server()
+        docs = [dict(doc) for doc in corpus.make_corpus(chunk, seed=2)]
+        for doc in docs:
+            doc['_id'] = 'save-' + doc.pop('_id')
+            del doc['_rev']
+        for i in xrange(int(count * scale)):
+            # ``save_docs`` updates the revisions in place, so each round
+            # overwrites the last without conflicts.
+            results = timer.time(shortcuts.save_docs, len(docs), docs,
+                'bench', server.url)
+            for error in shortcuts.get_conflicts(results):
+                timer.error()
+    return benchmark
+
+
+BENCHMARKS = [
+    ('couchdb.parse_specifier', call_benchmark(relax_couchdb.parse_specifier,
+        SPECIFIERS, 200000)),
+    ('couchdb.specifier_to_db', call_benchmark(relax_couchdb.specifier_to_db,
+        SPECIFIERS, 200000)),
+    ('couchdb.db_to_specifier', call_benchmark(relax_couchdb.db_to_specifier,
+        DB_STRINGS, 200000)),
+    ('couchdb.shortcuts.get_doc', get_doc_benchmark(shortcuts.get_doc)),
+    ('couchdb.doccache.get_doc', get_doc_benchmark(doccache.get_doc)),
+    ('couchdb.shortcuts.get_docs', get_docs_benchmark()),
+    ('couchdb.shortcuts.save_docs', save_docs_benchmark()),
+]
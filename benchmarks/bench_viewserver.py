@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks of the view server, driven through its line protocol.
+
+Lines are fed to a ``ViewServerProtocol`` in batches, just as
+``serve_stream`` does when CouchDB has several lines waiting, and each batch
+is one timed operation. Any output line which isn't a result (an error, or a
+log message from a failing function) counts as an error.
+"""
+
+from relax import codec
+from relax.viewserver import ViewServerProtocol
+
+from benchmarks import corpus
+
+
+def encode_lines(commands):
+    return [codec.dumps(command) + '\n' for command in commands]
+
+def count_errors(output):
+    return len([line for line in output.splitlines()
+        if not (line.startswith('[') or line == 'true')])
+
+def run_lines(timer, protocol, lines, batch_size, items_per_line=1):
+    """Feed lines to a protocol in timed batches."""
+    for start in xrange(0, len(lines), batch_size):
+        batch = lines[start:start + batch_size]
+        timer.time(protocol.handle_lines, len(batch) * items_per_line, batch)
+        for error in xrange(count_errors(protocol.take_output())):
+            timer.error()
+
+def setup_protocol(map_functions):
+    protocol = ViewServerProtocol()
+    protocol.handle_lines(encode_lines([['reset']] +
+        [['add_fun', name] for name in map_functions]))
+    protocol.take_output()
+    return protocol
+
+def map_benchmark(count, size, map_functions, batch_size=100):
+    def benchmark(timer, scale):
+        protocol = setup_protocol(map_functions)
+        lines = encode_lines(['map_doc', doc]
+            for doc in corpus.make_corpus(int(count * scale), size))
+        run_lines(timer, protocol, lines, batch_size)
+    return benchmark
+
+def mapped_rows(count):
+    """Return ``count`` rows of map output, as sent with ``reduce``."""
+    return [[[doc['type'], doc['_id']], doc['score']]
+        for doc in corpus.make_corpus(count)]
+
+def reduce_benchmark(reduce_functions, rows, repeat=20):
+    def benchmark(timer, scale):
+        protocol = setup_protocol([])
+        line = encode_lines([['reduce', reduce_functions,
+            mapped_rows(rows)]])
+        run_lines(timer, protocol, line * int(repeat * scale), 1,
+            items_per_line=rows)
+    return benchmark
+
+def rereduce_benchmark(reduce_functions, values, repeat=20):
+    def benchmark(timer, scale):
+        protocol = setup_protocol([])
+        line = encode_lines([['rereduce', reduce_functions,
+            range(values)]])
+        run_lines(timer, protocol, line * int(repeat * scale), 1,
+            items_per_line=values)
+    return benchmark
+
+def validate_benchmark(validator, count, batch_size=1):
+    def benchmark(timer, scale):
+        protocol = setup_protocol([])
+        lines = encode_lines(['validate', validator, doc, None, {}]
+            for doc in corpus.make_corpus(int(count * scale), 'medium'))
+        run_lines(timer, protocol, lines, batch_size)
+    return benchmark
+
+
+BENCHMARKS = [
+    ('viewserver.map.small.1fn', map_benchmark(5000, 'small',
+        ['benchmarks.corpus.map_by_type'])),
+    ('viewserver.map.small.unbatched', map_benchmark(5000, 'small',
+        ['benchmarks.corpus.map_by_type'], batch_size=1)),
+    ('viewserver.map.medium.3fn', map_benchmark(2000, 'medium',
+        corpus.MAP_FUNCTIONS[:3])),
+    ('viewserver.map.large.20fn', map_benchmark(200, 'large',
+        corpus.MAP_FUNCTIONS)),
+    ('viewserver.reduce.python.10k', reduce_benchmark(
+        ['benchmarks.corpus.reduce_sum'], 10000)),
+    ('viewserver.reduce.builtin.10k', reduce_benchmark(
+        ['_sum', '_count', '_stats'], 10000)),
+    ('viewserver.rereduce.python.10k', rereduce_benchmark(
+        ['benchmarks.corpus.reduce_sum'], 10000)),
+    ('viewserver.rereduce.builtin.10k', rereduce_benchmark(
+        ['_sum', '_count'], 10000)),
+    ('viewserver.validate', validate_benchmark(
+        'benchmarks.corpus.validate_has_type', 2000)),
+    ('viewserver.validate.schema', validate_benchmark(
+        'benchmarks.corpus.DOC_SCHEMA', 2000)),
+]
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+"""
+Synthetic document corpora, and the view functions the benchmarks run.
+
+Corpora are generated from a fixed seed, so every run (and every baseline)
+sees exactly the same documents.
+"""
+
+import random
+
+
+WORDS = ('alpha bravo charlie delta echo foxtrot golf hotel india juliet '
+    'kilo lima mike november oscar papa quebec romeo sierra tango uniform '
+    'victor whiskey xray yankee zulu').split()
+
+# Approximate number of body fields for each document size.
+SIZES = {'small': 4, 'medium': 40, 'large': 400}
+
+
+def make_doc(rng, doc_number, size):
+    """Return a single synthetic document of the given size."""
+    doc = {
+        '_id': 'doc-%08d' % (doc_number,),
+        '_rev': '1-%032x' % (rng.getrandbits(128),),
+        'type': rng.choice(('post', 'comment', 'user', 'tag')),
+        'score': rng.randint(0, 1000),
+        'tags': rng.sample(WORDS, 3),
+    }
+    for field_number in xrange(SIZES[size]):
+        if field_number % 3 == 0:
+            value = rng.random() * 100
+        elif field_number % 3 == 1:
+            value = ' '.join(rng.sample(WORDS, 5))
+        else:
+            value = {'nested': rng.randint(0, 100), 'word': rng.choice(WORDS)}
+        doc['field_%d' % (field_number,)] = value
+    return doc
+
+def make_corpus(count, size='small', seed=1):
+    """Return a list of ``count`` synthetic documents."""
+    rng = random.Random(seed)
+    return [make_doc(rng, doc_number, size) for doc_number in xrange(count)]
+
+
+## View functions, referred to by name in the benchmarks.
+
+def map_by_type(doc):
+    yield (doc['type'], doc['score'])
+
+def map_by_tag(doc):
+    for tag in doc['tags']:
+        yield (tag, 1)
+
+def map_fields(doc):
+    # Touches every field, like a full-text or schema-checking view would.
+    for key, value in doc.iteritems():
+        if isinstance(value, float):
+            yield ([doc['type'], key], value)
+
+def reduce_sum(keys, values, rereduce=False):
+    return sum(values)
+
+def validate_has_type(new_doc, old_doc, user_ctx):
+    if 'type' not in new_doc:
+        raise ValueError('Documents must have a type.')
+    return True
+
+# The same check and a few more, as a declarative schema (see relax.schema).
+DOC_SCHEMA = {
+    'type': {'required': True, 'choices': ['post', 'comment', 'user', 'tag']},
+    'score': {'required': True, 'type': 'integer', 'min': 0, 'max': 1000},
+    'tags': {'type': 'list', 'max_length': 10},
+}
+
+# Twenty map functions, for the many-functions benchmark.
+MAP_FUNCTIONS = ['benchmarks.corpus.' + name for name in (
+    'map_by_type', 'map_by_tag', 'map_fields', 'map_by_type')] * 5
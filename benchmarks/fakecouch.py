@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+"""
+An in-process stand-in for a CouchDB server, for benchmarking client code.
+
+It implements just enough of the CouchDB HTTP API for ``relax.couchdb``'s
+shortcuts: creating and inspecting databases, getting (with ETags), putting
+and deleting documents, ``_all_docs``/``_bulk_docs`` with keys, and
+continuous ``_changes`` feeds (sent chunked, as CouchDB does), and
+``_replicate`` between its own databases. Documents are held in memory, and
+connections are kept alive, so the numbers reflect the cost of the client code
+and the HTTP round trips rather than disk I/O.
+"""
+
+import BaseHTTPServer
+import socket
+import SocketServer
+import sys
+import time
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+import urllib
+import urlparse
+import uuid
+
+from relax import codec
+
+
+class FakeCouchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    
+    protocol_version = 'HTTP/1.1'
+    # Buffer each response up and send it in one go, so that the client's
+    # delayed ACKs don't stall it.
+    wbufsize = -1
+    
+    def log_message(self, *args):
+        pass
+    
+    def respond(self, status, body=None, headers=()):
+        data = '' if body is None else codec.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+    
+    def not_found(self):
+        self.respond(404, {'error': 'not_found', 'reason': 'missing'})
+    
+    def dispatch(self):
+        scheme, netloc, path, params, query, fragment = urlparse.urlparse(
+            self.path)
+        self.query = dict((name, codec.loads(value)
+            if value in ('true', 'false') or value[:1] in ('[', '{', '"')
+            else value) for (name, value) in urlparse.parse_qsl(query))
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = codec.loads(self.rfile.read(length)) if length else None
+        segments = [urllib.unquote(segment)
+            for segment in path.strip('/').split('/') if segment]
+        # ``_design/name`` is one document ID, however it's quoted.
+        if len(segments) > 2 and segments[1] == '_design':
+            segments[1:3] = ['/'.join(segments[1:3])]
+        server = self.server
+        # A changes feed streams for as long as it's open, so it mustn't
+        # hold the server's lock.
+        if segments[1:] == ['_changes']:
+            return self.handle_changes(segments[0])
+        server.lock.acquire()
+        try:
+            if not segments:
+                return self.respond(200, {'couchdb': 'Welcome',
+                    'version': '0.9.0'})
+            if segments == ['_replicate']:
+                return self.handle_replicate()
+            db_name = self.db_name = segments[0]
+            if len(segments) == 1:
+                return self.handle_db(db_name)
+            if db_name not in server.dbs:
+                return self.not_found()
+            if segments[1] == '_all_docs':
+                return self.handle_all_docs(server.dbs[db_name])
+            if segments[1] == '_bulk_docs':
+                return self.handle_bulk_docs(server.dbs[db_name])
+            return self.handle_doc(server.dbs[db_name], segments[1])
+        finally:
+            server.lock.release()
+    
+    do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = dispatch
+    
+    def handle_db(self, db_name):
+        dbs = self.server.dbs
+        if self.command == 'PUT':
+            if db_name in dbs:
+                return self.respond(412, {'error': 'file_exists'})
+            dbs[db_name] = {}
+            return self.respond(201, {'ok': True})
+        if db_name not in dbs:
+            return self.not_found()
+        if self.command == 'DELETE':
+            del dbs[db_name]
+            return self.respond(200, {'ok': True})
+        self.respond(200, {'db_name': db_name, 'doc_count': len(dbs[db_name]),
+            'update_seq': self.server.seq})
+    
+    def handle_doc(self, db, doc_id):
+        doc = db.get(doc_id)
+        if self.command in ('GET', 'HEAD'):
+            if doc is None:
+                return self.not_found()
+            etag = '"%s"' % (doc['_rev'],)
+            if self.headers.get('If-None-Match') == etag:
+                return self.respond(304, headers=[('ETag', etag)])
+            return self.respond(200, doc, headers=[('ETag', etag)])
+        if self.command == 'DELETE':
+            if doc is None:
+                return self.not_found()
+            if self.query.get('rev') != doc['_rev']:
+                return self.respond(409, {'error': 'conflict'})
+            del db[doc_id]
+            self.server.add_change(self.db_name, doc_id)
+            return self.respond(200, {'ok': True, 'id': doc_id})
+        result = self.save(db, dict(self.body, _id=doc_id))
+        self.respond('error' in result and 409 or 201, result)
+    
+    def save(self, db, doc):
+        if '_id' not in doc:
+            doc['_id'] = uuid.uuid4().hex
+        existing = db.get(doc['_id'])
+        if (existing and existing['_rev']) != doc.get('_rev'):
+            return {'id': doc['_id'], 'error': 'conflict',
+                'reason': 'Document update conflict.'}
+        if doc.pop('_deleted', False):
+            db.pop(doc['_id'], None)
+        else:
+            generation = int((doc.get('_rev') or '0-').split('-')[0]) + 1
+            doc['_rev'] = '%d-%s' % (generation, uuid.uuid4().hex)
+            db[doc['_id']] = doc
+        self.server.add_change(self.db_name, doc['_id'])
+        return {'id': doc['_id'], 'rev': doc.get('_rev', '')}
+    
+    def handle_all_docs(self, db):
+        if self.body and 'keys' in self.body:
+            doc_ids = self.body['keys']
+        else:
+            doc_ids = sorted(db)
+        rows = []
+        for doc_id in doc_ids:
+            doc = db.get(doc_id)
+            if doc is None:
+                rows.append({'key': doc_id, 'error': 'not_found'})
+                continue
+            row = {'id': doc_id, 'key': doc_id, 'value': {'rev': doc['_rev']}}
+            if self.query.get('include_docs'):
+                row['doc'] = doc
+            rows.append(row)
+        self.respond(200, {'total_rows': len(db), 'offset': 0, 'rows': rows})
+    
+    def handle_changes(self, db_name):
+        server = self.server
+        if self.query.get('feed') != 'continuous':
+            return self.respond(400, {'error': 'bad_request',
+                'reason': 'Only continuous feeds are supported.'})
+        since = int(self.query.get('since') or 0)
+        heartbeat = int(self.query.get('heartbeat') or 60000) / 1000.0
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        self.wfile.flush()
+        def write_chunk(data):
+            self.wfile.write('%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+        server.changed.acquire()
+        try:
+            while not server.closing:
+                lines = [codec.dumps({'seq': seq, 'id': doc_id,
+                    'changes': []}) + '\n'
+                    for (seq, change_db, doc_id) in server.changes
+                    if seq > since and change_db == db_name]
+                if server.changes:
+                    since = max(since, server.changes[-1][0])
+                if lines:
+                    write_chunk(''.join(lines))
+                else:
+                    server.changed.wait(heartbeat)
+                    if server.changes and server.changes[-1][0] > since:
+                        continue
+                    # Nothing new; send a heartbeat (an empty line).
+                    write_chunk('\n')
+            self.wfile.write('0\r\n\r\n')
+            self.wfile.flush()
+        except socket.error:
+            # The client hung up.
+            pass
+        finally:
+            server.changed.release()
+    
+    def handle_replicate(self):
+        dbs = self.server.dbs
+        # Sources and targets may be names or URLs; either way, the database
+        # name comes last.
+        source, target = [self.body[name].rstrip('/').rsplit('/', 1)[-1]
+            for name in ('source', 'target')]
+        for db_name in (source, target):
+            if db_name not in dbs:
+                # CouchDB 0.9 reports missing databases as a server error.
+                return self.respond(500, {'error': 'db_not_found',
+                    'reason': 'could not open %s' % (db_name,)})
+        doc_ids = self.body.get('doc_ids') or sorted(dbs[source])
+        written = 0
+        for doc_id in doc_ids:
+            if doc_id in dbs[source]:
+                dbs[target][doc_id] = dict(dbs[source][doc_id])
+                written += 1
+        now = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime())
+        self.respond(200, {'ok': True, 'session_id': uuid.uuid4().hex,
+            'source_last_seq': self.server.seq, 'history': [{
+                'start_time': now, 'end_time': now,
+                'docs_read': len(doc_ids), 'docs_written': written}]})
+    
+    def handle_bulk_docs(self, db):
+        self.respond(201, [self.save(db, dict(doc))
+            for doc in self.body['docs']])
+
+
+class FakeCouchServer(SocketServer.ThreadingMixIn,
+    BaseHTTPServer.HTTPServer):
+    
+    """
+    A threaded fake CouchDB server, listening on a random local port.
+    
+    Call ``start`` to serve in a background thread; ``url`` is then the
+    server's URL, as taken by ``relax.couchdb.shortcuts``.
+    """
+    
+    daemon_threads = True
+    
+    def __init__(self, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeCouchHandler)
+        self.lock = threading.Lock()
+        self.dbs = {}
+        self.seq = 0
+        # (seq, db_name, doc_id) for every update, for the changes feeds.
+        self.changes = []
+        self.changed = threading.Condition()
+        self.closing = False
+        self.url = 'http://%s:%d/' % self.server_address
+    
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+    
+    def handle_error(self, request, client_address):
+        # Clients hanging up on kept-alive connections are nothing to report,
+        # nor are errors in handler threads outliving the interpreter.
+        if sys is not None and not isinstance(sys.exc_info()[1],
+            socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                client_address)
+    
+    def add_change(self, db_name, doc_id):
+        """Record an update, waking up any changes feeds."""
+        self.changed.acquire()
+        try:
+            self.seq += 1
+            self.changes.append((self.seq, db_name, doc_id))
+            self.changed.notifyAll()
+        finally:
+            self.changed.release()
+    
+    def shutdown(self):
+        """Stop serving, and end any open changes feeds."""
+        self.changed.acquire()
+        try:
+            self.closing = True
+            self.changed.notifyAll()
+        finally:
+            self.changed.release()
+        BaseHTTPServer.HTTPServer.shutdown(self)
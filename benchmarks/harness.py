@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+"""
+Timing, reporting and baseline comparison for the benchmarks.
+
+A benchmark is a function which takes a ``Timer`` and calls ``timer.time`` for
+each operation it wants timed (one ``time`` call may cover several items,
+e.g. a batch of documents). The result of a benchmark is a dictionary of
+throughput (items per second), latency percentiles (per ``time`` call, in
+milliseconds), the peak resident memory of the process so far, and the number
+of operations which failed.
+"""
+
+import gc
+import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from relax import codec
+
+
+class Timer(object):
+    
+    def __init__(self):
+        self.latencies = []
+        self.items = 0
+        self.errors = 0
+    
+    def time(self, function, items=1, *args, **kwargs):
+        """Call a function, recording how long it took to handle ``items``."""
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.latencies.append(time.time() - start)
+            self.items += items
+    
+    def error(self):
+        """Count a failed operation."""
+        self.errors += 1
+
+
+def percentile(sorted_values, fraction):
+    """Return the nearest-rank percentile of some sorted values."""
+    if not sorted_values:
+        return 0.0
+    index = int(round(fraction * (len(sorted_values) - 1)))
+    return sorted_values[index]
+
+def peak_memory():
+    """Return the peak resident memory of this process, in kilobytes."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_benchmark(benchmark, *args):
+    """Run a benchmark function, returning its result dictionary."""
+    timer = Timer()
+    gc.collect()
+    benchmark(timer, *args)
+    latencies = sorted(timer.latencies)
+    total = sum(latencies)
+    return {
+        'items_per_sec': total and timer.items / total or 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'peak_kb': peak_memory(),
+        'errors': timer.errors,
+    }
+
+def format_result(name, result, baseline=None, tolerance=0.1):
+    """Return one line of report for a benchmark result."""
+    line = '%-32s %12.1f/s  p50 %9.3fms  p99 %9.3fms' % (name,
+        result['items_per_sec'], result['p50_ms'], result['p99_ms'])
+    if result['peak_kb'] is not None:
+        line += '  peak %7dKB' % (result['peak_kb'],)
+    if result['errors']:
+        line += '  %d ERRORS' % (result['errors'],)
+    if baseline and baseline.get('items_per_sec'):
+        ratio = result['items_per_sec'] / baseline['items_per_sec']
+        line += '  %5.2fx' % (ratio,)
+        if ratio < 1 - tolerance:
+            line += ' SLOWER'
+        elif ratio > 1 + tolerance:
+            line += ' FASTER'
+    return line
+
+def load_results(filename):
+    fp = open(filename)
+    try:
+        return codec.loads(fp.read())
+    finally:
+        fp.close()
+
+def save_results(filename, results):
+    fp = open(filename, 'w')
+    try:
+        fp.write(codec.dumps(results))
+    finally:
+        fp.close()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Run the django-relax benchmarks, optionally comparing against a baseline.
+
+Usage:
+    
+    python benchmarks/run.py [options] [name_filter ...]
+
+Only benchmarks whose names contain one of the filters are run (all of them,
+if there are none). To compare a change against the current code, save a
+baseline first, then compare against it:
+    
+    python benchmarks/run.py --save baseline.json
+    # ... make the change ...
+    python benchmarks/run.py --compare baseline.json
+
+Each line of the report gives the throughput (items per second: documents,
+rows or calls), the p50 and p99 latency of each timed operation, the peak
+resident memory of the process so far and, when comparing, the speed relative
+to the baseline.
+"""
+
+import optparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from benchmarks import bench_couchdb, bench_viewserver, harness
+
+
+BENCHMARKS = bench_viewserver.BENCHMARKS + bench_couchdb.BENCHMARKS
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [name_filter ...]')
+    parser.add_option('-s', '--save', dest='save', default=None,
+        help='Save the results to this JSON file.')
+    parser.add_option('-c', '--compare', dest='compare', default=None,
+        help='Compare the results against a JSON file saved with --save.')
+    parser.add_option('-t', '--tolerance', dest='tolerance', type='float',
+        default=0.1, help='Relative change to flag as slower/faster.')
+    parser.add_option('--scale', dest='scale', type='float', default=1.0,
+        help='Scale the size of every benchmark (e.g. 0.1 for a quick run).')
+    options, filters = parser.parse_args(argv)
+    baseline = {}
+    if options.compare:
+        baseline = harness.load_results(options.compare)
+    results = {}
+    try:
+        for name, benchmark in BENCHMARKS:
+            if filters and not [f for f in filters if f in name]:
+                continue
+            results[name] = harness.run_benchmark(benchmark, options.scale)
+            print harness.format_result(name, results[name],
+                baseline.get(name), options.tolerance)
+            sys.stdout.flush()
+    finally:
+        bench_couchdb.stop_server()
+    if options.save:
+        harness.save_results(options.save, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+A Django cache backend which stores its entries in a CouchDB database.
+
+To use it, set ``CACHE_BACKEND`` to ``'relax.cache://<specifier>'``, where
+``<specifier>`` is a database specifier (as taken by ``specifier_to_db``), for
+example ``'relax.cache://local:cache/?timeout=600'``. Each cache entry is
+stored as a document holding its pickled value and expiry time; because it's
+all just CouchDB, the cache can be replicated between servers.
+"""
+
+# Otherwise ``import couchdb`` would pick up ``relax.couchdb``.
+from __future__ import absolute_import
+
+import base64
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import logging
+import time
+
+import couchdb
+from django.core.cache.backends.base import BaseCache
+from django.utils.encoding import smart_str
+
+from relax import codec, settings, utils
+from relax.couchdb import parse_specifier, shortcuts
+from relax.couchdb.views import iterview
+
+
+DESIGN_DOC_ID = '_design/relax_cache'
+DESIGN_DOC = {
+    'language': 'javascript',
+    'views': {
+        'expiry': {
+            'map': ('function(doc) { if (doc.relax_cache_expires) '
+                'emit(doc.relax_cache_expires, doc._rev); }'),
+        },
+    },
+}
+
+
+class CacheClass(BaseCache):
+    
+    """
+    A cache backend which stores entries as documents in a CouchDB database.
+    
+    Documents are read with a single ``GET`` (or, for ``get_many``, a single
+    ``POST`` to ``_all_docs``) and written with a single ``POST`` to
+    ``_bulk_docs``. The last-known revision of each entry is remembered, so
+    overwriting a hot key doesn't need an extra round trip to find its current
+    revision; only conflicting writes (e.g. because another server changed the
+    entry) have their revisions looked up and are then retried.
+    
+    Expired entries are never returned, and are deleted in bulk by ``sweep``,
+    which finds them with a range query on a view keyed by expiry time (so it
+    never has to scan the whole database). ``sweep`` is run automatically
+    whenever an entry is written, at most once every ``sweep_interval``
+    seconds (the ``sweep_interval`` parameter in the backend URI, or 300).
+    Deleted entries leave behind only small tombstones, whose space is
+    reclaimed when the database is compacted.
+    """
+    
+    def __init__(self, db_spec, params):
+        BaseCache.__init__(self, params)
+        self.spec = parse_specifier(db_spec)
+        self.sweep_interval = int(params.get('sweep_interval', 300))
+        self.last_sweep = time.time()
+        self.revs = utils.LRUCache(settings._('COUCHDB_CACHE_REV_CACHE_SIZE',
+            1000))
+        self.logger = logging.getLogger('relax.cache')
+        self.spec.ensure_exists()
+        shortcuts.ensure_design_doc(self.get_db(), DESIGN_DOC_ID, DESIGN_DOC)
+    
+    def get_db(self):
+        return self.spec.get_db()
+    
+    def make_doc_id(self, key):
+        # Document IDs beginning with an underscore are reserved by CouchDB.
+        return 'cache:' + smart_str(key)
+    
+    def make_doc(self, key, value, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        doc_id = self.make_doc_id(key)
+        doc = {
+            '_id': doc_id,
+            'relax_cache_expires': time.time() + timeout,
+            'value': base64.b64encode(
+                pickle.dumps(value, pickle.HIGHEST_PROTOCOL)),
+        }
+        rev = self.revs.get(doc_id)
+        if rev is not None:
+            doc['_rev'] = rev
+        return doc
+    
+    def decode_doc(self, doc):
+        """Return the value stored in a document, or ``None`` if expired."""
+        if doc is None:
+            return None
+        self.revs[doc['_id']] = doc['_rev']
+        if doc.get('relax_cache_expires', 0) < time.time():
+            return None
+        return pickle.loads(base64.b64decode(doc['value']))
+    
+    def save_docs(self, docs):
+        
+        """
+        Write cache entry documents in bulk, overwriting any existing entries.
+        
+        Returns the IDs of the documents which couldn't be written.
+        """
+        
+        db_name, server_url = self.spec.database, self.spec.server_url
+        results = shortcuts.save_docs(docs, db_name, server_url)
+        conflicts = set(shortcuts.get_conflicts(results))
+        if conflicts:
+            # Our idea of these documents' revisions was out of date.
+            retry = [doc for doc in docs if doc['_id'] in conflicts]
+            revs = shortcuts.get_revs([doc['_id'] for doc in retry], db_name,
+                server_url)
+            for doc, rev in zip(retry, revs):
+                doc.pop('_rev', None)
+                if rev is not None:
+                    doc['_rev'] = rev
+            results = [result for result in results
+                if result['id'] not in conflicts]
+            results.extend(shortcuts.save_docs(retry, db_name, server_url))
+        failed = []
+        for result in results:
+            if 'error' in result:
+                self.revs.pop(result['id'])
+                failed.append(result['id'])
+            else:
+                self.revs[result['id']] = result['rev']
+        if time.time() - self.last_sweep > self.sweep_interval:
+            self.sweep()
+        return failed
+    
+    def add(self, key, value, timeout=None):
+        """Set a value only if the key isn't already in the cache."""
+        doc = self.make_doc(key, value, timeout)
+        doc.pop('_rev', None)
+        db = self.get_db()
+        try:
+            resp_headers, resp_body = db.resource.put(doc['_id'],
+                content=codec.dumps(doc))
+        except couchdb.client.ResourceConflict:
+            # An entry exists, but it may have expired.
+            try:
+                resp_headers, existing = db.resource.get(doc['_id'])
+            except couchdb.client.ResourceNotFound:
+                return False
+            if self.decode_doc(existing) is not None:
+                return False
+            doc['_rev'] = existing['_rev']
+            return not self.save_docs([doc])
+        # Remember the revision, so a later ``set`` doesn't conflict.
+        self.revs[doc['_id']] = resp_body['rev']
+        return True
+    
+    def get(self, key, default=None):
+        try:
+            resp_headers, doc = self.get_db().resource.get(
+                self.make_doc_id(key))
+        except couchdb.client.ResourceNotFound:
+            return default
+        value = self.decode_doc(doc)
+        if value is None:
+            return default
+        return value
+    
+    def set(self, key, value, timeout=None):
+        self.save_docs([self.make_doc(key, value, timeout)])
+    
+    def delete(self, key):
+        self.delete_many([key])
+    
+    def get_many(self, keys):
+        doc_ids = map(self.make_doc_id, keys)
+        docs = shortcuts.get_docs(doc_ids, self.spec.database,
+            self.spec.server_url)
+        results = {}
+        for key, doc in zip(keys, docs):
+            value = self.decode_doc(doc)
+            if value is not None:
+                results[key] = value
+        return results
+    
+    def set_many(self, data, timeout=None):
+        self.save_docs([self.make_doc(key, value, timeout)
+            for (key, value) in data.items()])
+    
+    def delete_many(self, keys):
+        doc_ids = map(self.make_doc_id, keys)
+        revs = shortcuts.get_revs(doc_ids, self.spec.database,
+            self.spec.server_url)
+        self.delete_docs(zip(doc_ids, revs))
+    
+    def delete_docs(self, doc_revs):
+        """Delete documents in bulk, given their IDs and revisions."""
+        docs = [{'_id': doc_id, '_rev': rev, '_deleted': True}
+            for (doc_id, rev) in doc_revs if rev is not None]
+        if docs:
+            shortcuts.save_docs(docs, self.spec.database, self.spec.server_url)
+        for doc in docs:
+            self.revs.pop(doc['_id'])
+    
+    def has_key(self, key):
+        return self.get(key) is not None
+    
+    def delete_rows(self, rows):
+        """Delete the documents in rows of the expiry view, a page at a time."""
+        page_size = settings._('COUCHDB_BULK_CHUNK_SIZE', 500)
+        count = 0
+        for chunk in shortcuts.chunks(rows, page_size):
+            self.delete_docs([(row['id'], row['value']) for row in chunk])
+            count += len(chunk)
+        return count
+    
+    def clear(self):
+        """Delete every entry in the cache."""
+        self.delete_rows(iterview(self.spec.specifier, 'relax_cache/expiry'))
+    
+    def sweep(self):
+        
+        """
+        Delete every expired entry in the cache, returning how many there were.
+        
+        Expired entries are found with a range query on the expiry view, up to
+        the current time.
+        """
+        
+        self.last_sweep = now = time.time()
+        count = self.delete_rows(iterview(self.spec.specifier,
+            'relax_cache/expiry', endkey=now))
+        self.logger.debug('Swept %d expired entries from %r' % (count,
+            self.spec.specifier))
+        return count
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+"""
+Pluggable JSON codec, preferring the fastest encoder/decoder available.
+
+The candidates are tried in the order given by ``CODEC_PREFERENCE``; the first
+one which can be imported wins, unless the ``RELAX_JSON_CODEC`` setting names a
+particular codec. Every codec here emits compact, single-line JSON (newlines
+inside strings are always escaped), so its output can be written straight to a
+line-oriented protocol like the view server's.
+
+``ujson`` is never picked automatically: the releases which support Python 2
+write floats with at most 15 significant digits (9 by default), whereas a
+double needs 17 to round-trip, so it would silently alter numbers in keys,
+values and documents. Set ``RELAX_JSON_CODEC = 'ujson'`` only if that loss of
+precision is acceptable.
+
+    >>> from relax import codec
+    >>> codec.dumps({'a': [1, 2]})
+    '{"a":[1,2]}'
+    >>> codec.loads('{"a": [1, 2]}')
+    {u'a': [1, 2]}
+"""
+
+from relax import settings
+
+
+class CodecNotAvailable(Exception):
+    
+    def __init__(self, codec_name):
+        Exception.__init__(self, 'JSON codec %r not available.' % (codec_name,))
+
+
+def _ujson():
+    import ujson
+    def dumps(obj):
+        # The default of 9 digits truncates floats; 15 is the most ujson 1.x
+        # allows.
+        return ujson.dumps(obj, double_precision=15)
+    def loads(string):
+        return ujson.loads(string, precise_float=True)
+    return loads, dumps
+
+def _simplejson_speedups():
+    import simplejson
+    # Only worth preferring over the standard library if it's C-accelerated.
+    from simplejson import _speedups
+    return simplejson.loads, _compact_dumps(simplejson)
+
+def _json():
+    import json
+    return json.loads, _compact_dumps(json)
+
+def _simplejson():
+    import simplejson
+    return simplejson.loads, _compact_dumps(simplejson)
+
+def _django_simplejson():
+    from django.utils import simplejson
+    return simplejson.loads, _compact_dumps(simplejson)
+
+def _compact_dumps(module):
+    """Return a ``dumps`` for a ``json``-like module which emits no spaces."""
+    encoder = module.JSONEncoder(separators=(',', ':'))
+    return encoder.encode
+
+
+CODECS = {
+    'ujson': _ujson,
+    'simplejson_speedups': _simplejson_speedups,
+    'json': _json,
+    'simplejson': _simplejson,
+    'django_simplejson': _django_simplejson,
+}
+
+CODEC_PREFERENCE = ('simplejson_speedups', 'json', 'simplejson',
+    'django_simplejson')
+
+
+def get_codec(codec_name=None):
+    """
+    Return a ``(name, loads, dumps)`` triple for a JSON codec.
+    
+    If ``codec_name`` is given, that codec is returned (or
+    ``CodecNotAvailable`` raised); otherwise the first importable codec in
+    ``CODEC_PREFERENCE`` is used.
+    """
+    if codec_name:
+        try:
+            loads, dumps = CODECS[codec_name]()
+        except (KeyError, ImportError):
+            raise CodecNotAvailable(codec_name)
+        return codec_name, loads, dumps
+    for codec_name in CODEC_PREFERENCE:
+        try:
+            loads, dumps = CODECS[codec_name]()
+        except ImportError:
+            continue
+        return codec_name, loads, dumps
+    raise CodecNotAvailable(None)
+
+
+name, loads, dumps = get_codec(settings._('RELAX_JSON_CODEC', None))
@@ -3,7 +3,7 @@
 import re
 import urlparse
 
-from relax import settings
+from relax import settings, utils
 from relax.couchdb import shortcuts
 
 
@@ -22,6 +22,153 @@ URL_RE = re.compile(r'^(http:\/\/)(?P<hostname>([A-Za-z0-9]|[A-Za-z0-9]'
     r'(?P<portnum>\d+)\/(?P<database>[A-Za-z][A-Za-z0-9\_\$\(\)\+\-\/]+)$')
 
 
+
+
+class DatabaseSpec(object):
+    
+    """
+    A resolved database specifier or database string.
+    
+    Instances are immutable, and record the URL of the server which holds the
+    database (``server_url``), the name of the database (``database``) and
+    whether that server is the locally-configured one (``is_local``). Use
+    ``parse_specifier`` and ``parse_db_string`` to get hold of them.
+    """
+    
+    __slots__ = ('server_url', 'database', 'is_local')
+    
+    def __init__(self, server_url, database, is_local):
+        self.server_url = server_url
+        self.database = database
+        self.is_local = is_local
+    
+    def __repr__(self):
+        return 'DatabaseSpec(%r)' % (self.specifier,)
+    
+    def __eq__(self, other):
+        return (isinstance(other, DatabaseSpec) and
+            (self.server_url, self.database) ==
+            (other.server_url, other.database))
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return hash((self.server_url, self.database))
+    
+    @property
+    def specifier(self):
+        """The canonical database specifier, as taken by ``specifier_to_db``."""
+        if self.is_local:
+            return 'local:' + self.database
+        return 'remote:%s:%s' % (self.server_url[len('http://'):],
+            self.database)
+    
+    @property
+    def db_string(self):
+        """The database name (if local) or URL (if remote), for CouchDB."""
+        if self.is_local:
+            return self.database
+        return '%s/%s' % (self.server_url, self.database)
+    
+    def get_server(self):
+        """Return a (pooled) CouchDB server instance for this database."""
+        return shortcuts.get_server(self.server_url)
+    
+    def get_db(self):
+        """Return a (pooled) CouchDB database instance for this database."""
+        return shortcuts.get_db(self.database, self.server_url)
+    
+    def ensure_exists(self):
+        """Make sure this database exists, creating it if necessary."""
+        server = self.get_server()
+        if self.database not in server:
+            server.create(self.database)
+
+
+# Maps specifiers and database strings to ``DatabaseSpec`` instances. The keys
+# include the local server's URL, so changing it doesn't return stale results.
+_spec_cache = utils.LRUCache(settings._('COUCHDB_SPEC_CACHE_SIZE', 1024))
+# Maps local server URLs to (URL, hostname, port number) triples.
+_local_servers = {}
+
+def local_server():
+    """Return the configured local server as a (URL, host, port) triple."""
+    local_url = settings._('COUCHDB_SERVER', 'http://127.0.0.1:5984/')
+    try:
+        return _local_servers[local_url]
+    except KeyError:
+        netloc = urlparse.urlparse(local_url)[1]
+        localhost, localport = (netloc.split(':') + ['5984'])[:2]
+        result = ('http://%s:%s' % (localhost, localport), localhost,
+            localport)
+        _local_servers[local_url] = result
+        return result
+
+def _make_spec(hostname, portnum, database):
+    local_url, localhost, localport = local_server()
+    # If it's the local server, then make a local spec.
+    if (localhost == hostname) and (localport == portnum):
+        return DatabaseSpec(local_url, database, True)
+    return DatabaseSpec('http://%s:%s' % (hostname, portnum), database, False)
+
+def parse_specifier(db_spec):
+    """
+    Return the ``DatabaseSpec`` for a database specifier.
+    
+    See ``specifier_to_db`` for the format of specifiers. Results are cached,
+    so repeated lookups of the same specifier don't hit the regexes again.
+    """
+    local_url = local_server()[0]
+    cache_key = ('spec', db_spec, local_url)
+    spec = _spec_cache.get(cache_key)
+    if spec is not None:
+        return spec
+    # Only the regex corresponding to the specifier's prefix is tried.
+    if db_spec.startswith('local:'):
+        match = LOCAL_RE.match(db_spec)
+        if match:
+            spec = DatabaseSpec(local_url, match.group('database'), True)
+    elif db_spec.startswith('remote:'):
+        match = REMOTE_RE.match(db_spec)
+        if match:
+            spec = _make_spec(*match.group('hostname', 'portnum', 'database'))
+    else:
+        match = PLAIN_RE.match(db_spec)
+        if match:
+            spec = DatabaseSpec(local_url, match.group('database'), True)
+    if spec is None:
+        # Throw a wobbly.
+        raise ValueError('Invalid database spec: %r' % (db_spec,))
+    _spec_cache[cache_key] = spec
+    return spec
+
+def parse_db_string(db_string):
+    """
+    Return the ``DatabaseSpec`` for a database string (a name or a URL).
+    
+    Results are cached, in the same way as for ``parse_specifier``.
+    """
+    local_url = local_server()[0]
+    cache_key = ('db', db_string, local_url)
+    spec = _spec_cache.get(cache_key)
+    if spec is not None:
+        return spec
+    if db_string.startswith('http://'):
+        match = URL_RE.match(db_string)
+        if match:
+            spec = _make_spec(*match.group('hostname', 'portnum', 'database'))
+    else:
+        match = PLAIN_RE.match(db_string)
+        if match:
+            spec = DatabaseSpec(local_url, match.group('database'), True)
+    if spec is None:
+        # Throw a wobbly.
+        raise ValueError('Invalid database string: %r' % (db_string,))
+    _spec_cache[cache_key] = spec
+    return spec
+
+
 def specifier_to_db(db_spec):
     """
     Return the database string for a database specifier.
@@ -43,29 +190,7 @@ def specifier_to_db(db_spec):
     specs are turned into the database name alone, and remote specs are turned
     into ``'http://host:port/db_name'`` URLs.
     """
-    local_match = LOCAL_RE.match(db_spec)
-    remote_match = REMOTE_RE.match(db_spec)
-    plain_match = PLAIN_RE.match(db_spec)
-    # If this looks like a local specifier:
-    if local_match:
-        return local_match.groupdict()['database']
-    # If this looks like a remote specifier:
-    elif remote_match:
-        # A fancy 'unpacking'...
-        hostname, portnum, database = map(remote_match.groupdict().get,
-            ('hostname', 'portnum', 'database'))
-        local_url = settings._('COUCHDB_SERVER', 'http://127.0.0.1:5984/')
-        localhost, localport = urlparse.urlparse(local_url)[1].split(':')
-        # If it's local, return a local DB string.
-        if (localhost == hostname) and (localport == portnum):
-            return database
-        # Otherwise, get a remote URL.
-        return 'http://%s:%s/%s' % (hostname, portnum, database)
-    # If this looks like a plain database name, return it.
-    elif plain_match:
-        return plain_match.groupdict()['database']
-    # Throw a wobbly.
-    raise ValueError('Invalid database spec: %r' % (db_spec,))
+    return parse_specifier(db_spec).db_string
 
 
 def db_to_specifier(db_string):
@@ -76,91 +201,32 @@ def db_to_specifier(db_string):
     format accepted by ``specifier_to_db``. It is recommended that you consult
     the documentation for that function for an explanation of the format.
     """
-    local_match = PLAIN_RE.match(db_string)
-    remote_match = URL_RE.match(db_string)
-    # If this looks like a local specifier:
-    if local_match:
-        return 'local:' + local_match.groupdict()['database']
-    # If this looks like a remote specifier:
-    elif remote_match:
-        # Just a fancy way of getting 3 variables in 2 lines...
-        hostname, portnum, database = map(remote_match.groupdict().get,
-            ('hostname', 'portnum', 'database'))
-        local_url = settings._('COUCHDB_SERVER', 'http://127.0.0.1:5984/')
-        localhost, localport = urlparse.urlparse(local_url)[1].split(':')
-        # If it's the local server, then return a local specifier.
-        if (localhost == hostname) and (localport == portnum):
-            return 'local:' + database
-        # Otherwise, prepare and return the remote specifier.
-        return 'remote:%s:%s:%s' % (hostname, portnum, database)
-    # Throw a wobbly.
-    raise ValueError('Invalid database string: %r' % (db_string,))
+    return parse_db_string(db_string).specifier
 
 def get_server_from_db(db_string):
     """Return a CouchDB server instance from a database string."""
-    local_match = PLAIN_RE.match(db_string)
-    remote_match = URL_RE.match(db_string)
-    # If this looks like a local specifier:
-    if local_match:
-        return shortcuts.get_server()
-    elif remote_match:
-        hostname, portnum, database = map(remote_match.groupdict().get,
-            ('hostname', 'portnum', 'database'))
-        local_url = settings._('COUCHDB_SERVER', 'http://127.0.0.1:5984/')
-        localhost, localport = urlparse.urlparse(local_url)[1].split(':')
-        # If it's the local server, then return a local specifier.
-        if (localhost == hostname) and (localport == portnum):
-            return shortcuts.get_server()
-        return shortcuts.get_server(
-            server_url=('http://%s:%s' % (hostname, portnum)))
-    raise ValueError('Invalid database string: %r' % (db_string,))
+    return parse_db_string(db_string).get_server()
 
 def get_server_from_specifier(db_spec):
     """Return a CouchDB server instance from a database specifier."""
-    return get_server_from_db(specifier_to_db(db_spec))
+    return parse_specifier(db_spec).get_server()
 
 def get_db_from_db(db_string):
     """Return a CouchDB database instance from a database string."""
-    server = get_server_from_db(db_string)
-    local_match = PLAIN_RE.match(db_string)
-    remote_match = URL_RE.match(db_string)
-    # If this looks like a local specifier:
-    if local_match:
-        return server[local_match.groupdict()['database']]
-    elif remote_match:
-        return server[remote_match.groupdict()['database']]
-    raise ValueError('Invalid database string: %r' % (db_string,))
+    return parse_db_string(db_string).get_db()
 
 def get_db_from_specifier(db_spec):
     """Return a CouchDB database instance from a database specifier."""
-    return get_db_from_db(specifier_to_db(db_spec))
+    return parse_specifier(db_spec).get_db()
 
 def ensure_specifier_exists(db_spec):
     """Make sure a DB specifier exists, creating it if necessary."""
-    local_match = LOCAL_RE.match(db_spec)
-    remote_match = REMOTE_RE.match(db_spec)
-    plain_match = PLAIN_RE.match(db_spec)
-    if local_match:
-        db_name = local_match.groupdict().get('database')
-        server = shortcuts.get_server()
-        if db_name not in server:
-            server.create(db_name)
-        return True
-    elif remote_match:
-        hostname, portnum, database = map(remote_match.groupdict().get,
-            ('hostname', 'portnum', 'database'))
-        server = shortcuts.get_server(
-            server_url=('http://%s:%s' % (hostname, portnum)))
-        if database not in server:
-            server.create(database)
-        return True
-    elif plain_match:
-        db_name = plain_match.groupdict().get('database')
-        server = shortcuts.get_server()
-        if db_name not in server:
-            server.create(db_name)
-        return True
-    return False
+    try:
+        spec = parse_specifier(db_spec)
+    except ValueError:
+        return False
+    spec.ensure_exists()
+    return True
 
 def ensure_db_exists(db_string):
     """Make sure a DB string exists, creating it if necessary."""
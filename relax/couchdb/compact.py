@@ -1,12 +1,17 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import Queue
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
 import time
 import urlparse
 
 import couchdb
 
-from relax import DEFAULT_FORMATTER
+from relax import DEFAULT_FORMATTER, codec, settings
 from relax.couchdb import (get_server_from_specifier, get_db_from_specifier,
     specifier_to_db, shortcuts)
 
@@ -15,7 +20,74 @@ class CompactionError(Exception):
     pass
 
 
-def compact(db_spec, poll_interval=0):
+# The ID of the local (i.e. non-replicating) document in which the update
+# sequence of each database at its last compaction is recorded.
+CHECKPOINT_DOC_ID = '_local/relax-compaction'
+
+
+def fragmentation(db_info):
+    """Return the fraction of a database file which compaction would free."""
+    disk_size = db_info.get('disk_size', 0)
+    if not disk_size:
+        return 0.0
+    # Older versions of CouchDB don't report ``data_size``; assume the worst.
+    data_size = db_info.get('data_size', 0)
+    return max(0.0, (disk_size - data_size) / float(disk_size))
+
+def get_last_compacted_seq(db):
+    """Return the update sequence of a database at its last compaction."""
+    checkpoint = shortcuts.get_local_doc(db, CHECKPOINT_DOC_ID) or {}
+    return checkpoint.get('update_seq')
+
+def record_compaction(db):
+    """Record a database's current update sequence as its last compaction."""
+    shortcuts.save_local_doc(db, CHECKPOINT_DOC_ID,
+        {'update_seq': db.info().get('update_seq')})
+
+def compaction_report(db_spec, threshold=None):
+    
+    """
+    Return a dictionary describing whether a database is worth compacting.
+    
+    A database is worth compacting if it has been updated since it was last
+    compacted (by this module), and if the fraction of its file taken up by
+    old revisions and other garbage is at least ``threshold``. This defaults to
+    the ``COUCHDB_COMPACT_THRESHOLD`` setting, or 0 (i.e. compact anything
+    which has changed). The report contains the database's ``disk_size``,
+    ``data_size``, ``fragmentation``, ``update_seq`` and
+    ``last_compacted_seq``, plus the verdict (``compact``) and the ``reason``
+    for it.
+    """
+    
+    if threshold is None:
+        threshold = settings._('COUCHDB_COMPACT_THRESHOLD', 0.0)
+    db = get_db_from_specifier(db_spec)
+    db_info = db.info()
+    report = {
+        'db_spec': db_spec,
+        'disk_size': db_info.get('disk_size', 0),
+        'data_size': db_info.get('data_size'),
+        'fragmentation': fragmentation(db_info),
+        'update_seq': db_info.get('update_seq'),
+        'last_compacted_seq': get_last_compacted_seq(db),
+    }
+    if (report['update_seq'] is not None and
+        report['update_seq'] == report['last_compacted_seq']):
+        report['compact'] = False
+        report['reason'] = 'no updates since last compaction'
+    elif report['fragmentation'] < threshold:
+        report['compact'] = False
+        report['reason'] = 'fragmentation %.1f%% below threshold %.1f%%' % (
+            report['fragmentation'] * 100, threshold * 100)
+    else:
+        report['compact'] = True
+        report['reason'] = 'fragmentation %.1f%%' % (
+            report['fragmentation'] * 100,)
+    return report
+
+
+def compact(db_spec, poll_interval=0, threshold=None, force=False,
+    views=False, warm=False):
     
     """
     Compact a CouchDB database with optional synchronicity.
@@ -34,18 +106,72 @@ def compact(db_spec, poll_interval=0):
     seconds) representing the time to take between polls. A sensible default
     may be around 0.5 (seconds).
     
+    Databases which aren't worth compacting (see ``compaction_report``, which
+    is passed ``threshold``) are skipped, unless ``force`` is true; in this
+    case, ``True`` (or a function which always returns ``True``) is returned
+    straight away.
+    
+    If ``views`` is true, then once the database itself has been compacted,
+    the view indexes of each of its design documents are compacted too (see
+    ``compact_views``). If ``warm`` is true, the views are then queried so that
+    their indexes are up to date (see ``warm_views``). In asynchronous mode,
+    these steps are carried out by the returned function, once it sees that
+    the previous step has completed.
+    
     Because this function operates on database specifiers, you can choose to
     operate on the local server or any remote server.
     """
     
+    result = compact_database(db_spec, poll_interval=poll_interval,
+        threshold=threshold, force=force)
+    if not (views or warm):
+        return result
+    # Synchronous compaction
+    if poll_interval:
+        if views:
+            compact_views(db_spec, poll_interval=poll_interval)
+        if warm:
+            warm_views(db_spec)
+        return result
+    # Asynchronous compaction; each step starts once the last has completed.
+    state = {'database': False, 'views': None, 'warmed': False}
+    def check_completed():
+        if not state['database']:
+            state['database'] = result()
+            if not state['database']:
+                return False
+            if views:
+                state['views'] = compact_views(db_spec)
+        if state['views'] is not None and not state['views']():
+            return False
+        if warm and not state['warmed']:
+            warm_views(db_spec)
+            state['warmed'] = True
+        return True
+    return check_completed
+
+def compact_database(db_spec, poll_interval=0, threshold=None, force=False):
+    """Compact a database file; see ``compact`` for the arguments."""
     server = get_server_from_specifier(db_spec)
     db = get_db_from_specifier(db_spec)
     # Get logger
     logger = logging.getLogger('relax.couchdb.compact')
+    if not force:
+        report = compaction_report(db_spec, threshold=threshold)
+        if not report['compact']:
+            logger.info('Skipping compaction of %r: %s' % (db_spec,
+                report['reason']))
+            if not poll_interval:
+                return lambda: True
+            return True
     logger.info('Pre-compact size of %r: %s' % (db_spec,
         repr_bytes(db.info()['disk_size']),))
     logger.debug('POST ' + urlparse.urljoin(db.resource.uri + '/', '_compact'))
     # Start compaction process by issuing a POST to '/<db_name>/_compact'.
+    # Once it has been accepted, the database's current update sequence is
+    # recorded, so the next run can skip it if nothing has changed since.
+    # (Compaction itself doesn't change the update sequence, and any updates
+    # made while it runs may not be compacted, so now is the right moment.)
     resp_headers, resp_body = db.resource.post('/_compact')
     # Asynchronous compaction
     if not poll_interval:
@@ -55,6 +181,7 @@ def compact(db_spec, poll_interval=0):
             # Give the exception some useful information.
             err.response = (resp_headers, resp_body)
             raise err
+        record_compaction(db)
         # Return a function which, when called, will return whether or not the
         # compaction process is still running.
         def check_completed():
@@ -70,6 +197,7 @@ def compact(db_spec, poll_interval=0):
         return check_completed
     # Synchronous compaction
     elif poll_interval > 0:
+        record_compaction(db)
         logger.debug(
             'Polling database to check if compaction has completed')
         logger.debug('GET ' + db.resource.uri + '/')
@@ -90,6 +218,171 @@ def compact(db_spec, poll_interval=0):
     else:
         raise ValueError('Poll interval must be greater than zero.')
 
+def get_design_docs(db):
+    """Return a list of the design documents in a database."""
+    resp_headers, resp_body = db.resource.get('_all_docs',
+        startkey=codec.dumps('_design/'), endkey=codec.dumps('_design0'),
+        include_docs=True)
+    return [row['doc'] for row in resp_body['rows']]
+
+def compact_views(db_spec, poll_interval=0):
+    
+    """
+    Compact the view indexes of every design document in a database.
+    
+    Like ``compact``, this runs asynchronously by default, returning a function
+    which will return whether or not all of the view compactions have
+    completed; if ``poll_interval`` is given, it will instead poll the design
+    documents until they have, and then return ``True``.
+    """
+    
+    db = get_db_from_specifier(db_spec)
+    logger = logging.getLogger('relax.couchdb.compact')
+    running = []
+    for design_doc in get_design_docs(db):
+        design_name = design_doc['_id'][len('_design/'):]
+        resource = shortcuts.get_resource(db.resource, '_compact', design_name)
+        logger.debug('POST ' + resource.uri)
+        resource.post()
+        running.append(design_name)
+    def check_completed():
+        for design_name in list(running):
+            resource = shortcuts.get_resource(db.resource, '_design',
+                design_name, '_info')
+            logger.debug('GET ' + resource.uri)
+            resp_headers, info = resource.get()
+            if not info.get('view_index', {}).get('compact_running', False):
+                logger.info('Compacted views of %r in %r' % (design_name,
+                    db_spec))
+                running.remove(design_name)
+        return not running
+    if not poll_interval:
+        return check_completed
+    while not check_completed():
+        time.sleep(poll_interval)
+    return True
+
+def warm_views(db_spec, concurrency=None):
+    
+    """
+    Bring the view indexes of every design document in a database up to date.
+    
+    A cheap query (``limit=1``) is made against one view of each design
+    document; CouchDB builds all of the views in a design document together,
+    so this updates every index in the database. Design documents are queried
+    in parallel, by up to ``concurrency`` threads (defaulting to the
+    ``COUCHDB_WARM_CONCURRENCY`` setting, or 4). Returns a dictionary mapping
+    each design document's name to ``True`` or ``False``, depending on whether
+    its query succeeded.
+    """
+    
+    if concurrency is None:
+        concurrency = settings._('COUCHDB_WARM_CONCURRENCY', 4)
+    logger = logging.getLogger('relax.couchdb.compact')
+    tasks = Queue.Queue()
+    for design_doc in get_design_docs(get_db_from_specifier(db_spec)):
+        if design_doc.get('views'):
+            tasks.put((design_doc['_id'][len('_design/'):],
+                sorted(design_doc['views'])[0]))
+    results = {}
+    def worker():
+        # Each thread gets its own database handle from the pool.
+        db = get_db_from_specifier(db_spec)
+        while True:
+            try:
+                design_name, view_name = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            resource = shortcuts.get_resource(db.resource, '_design',
+                design_name, '_view', view_name)
+            logger.debug('GET ' + resource.uri)
+            try:
+                resource.get(limit=1)
+            except Exception, exc:
+                logger.error('Error warming views of %r in %r: %r' % (
+                    design_name, db_spec, exc))
+                results[design_name] = False
+            else:
+                results[design_name] = True
+    threads = [threading.Thread(target=worker)
+        for i in xrange(min(concurrency, tasks.qsize()))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def reclaimable_space(db_spec):
+    """Return roughly how many bytes compacting a database would free up."""
+    db_info = get_db_from_specifier(db_spec).info()
+    disk_size = db_info.get('disk_size', 0)
+    # Older versions of CouchDB don't report ``data_size``; assume the worst.
+    return disk_size - db_info.get('data_size', 0)
+
+def compact_many(db_specs, concurrency=None, poll_interval=0.4,
+    threshold=None, force=False, views=False, warm=False):
+    
+    """
+    Compact several CouchDB databases, running a few compactions at a time.
+    
+    Databases are compacted in order of how much space compacting them would
+    reclaim (largest first), with at most ``concurrency`` compactions running
+    at once; this defaults to the ``COUCHDB_COMPACT_CONCURRENCY`` setting, or
+    4. A single loop polls every in-flight compaction each ``poll_interval``
+    seconds, and starts the next compaction as soon as one finishes.
+    
+    ``threshold``, ``force``, ``views`` and ``warm`` are passed on to
+    ``compact``. Returns a
+    dictionary mapping each database specifier to ``True`` if its compaction
+    completed (or was skipped) or ``False`` if it failed.
+    """
+    
+    if concurrency is None:
+        concurrency = settings._('COUCHDB_COMPACT_CONCURRENCY', 4)
+    if concurrency < 1:
+        raise ValueError('Concurrency must be at least one.')
+    if poll_interval <= 0:
+        raise ValueError('Poll interval must be greater than zero.')
+    logger = logging.getLogger('relax.couchdb.compact')
+    results = {}
+    # Work out which databases are most worth compacting first.
+    sizes = {}
+    for db_spec in db_specs:
+        try:
+            sizes[db_spec] = reclaimable_space(db_spec)
+        except Exception, exc:
+            logger.error('Could not get info for %r: %r' % (db_spec, exc))
+            results[db_spec] = False
+    # Sorted smallest first, so that ``pop()`` takes the largest.
+    pending = sorted(sizes, key=sizes.get)
+    running = {}
+    while pending or running:
+        # Top up the set of running compactions.
+        while pending and len(running) < concurrency:
+            db_spec = pending.pop()
+            logger.debug('Compacting %r (%s reclaimable)' % (db_spec,
+                repr_bytes(sizes[db_spec])))
+            try:
+                running[db_spec] = compact(db_spec, threshold=threshold,
+                    force=force, views=views, warm=warm)
+            except Exception, exc:
+                logger.error('Error compacting %r: %r' % (db_spec, exc))
+                results[db_spec] = False
+        if not running:
+            continue
+        time.sleep(poll_interval)
+        # Poll every in-flight compaction.
+        for db_spec, check_completed in running.items():
+            try:
+                completed = check_completed()
+            except Exception, exc:
+                logger.error('Error polling %r: %r' % (db_spec, exc))
+                completed, results[db_spec] = True, False
+            if completed:
+                del running[db_spec]
+                results.setdefault(db_spec, True)
+    return results
+
 def repr_bytes(bytes):
     sizes = 'B KB MB GB TB PB'.split()
     size_index = 0
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+"""
+A process-local cache of CouchDB documents.
+
+Documents are cached in a bounded LRU, keyed by server, database, document ID
+and (optionally) revision. A document at a particular revision never changes,
+so revision-pinned lookups are served straight from the cache. Lookups of the
+latest revision are revalidated with a conditional ``GET`` (sending the cached
+revision's ETag in ``If-None-Match``), which costs a round trip but no body; or,
+if a background ``_changes`` follower is running for the database (see
+``DocumentCache.follow``), they are served straight from the cache too, and the
+follower evicts documents as they change.
+"""
+
+import httplib
+import logging
+import socket
+import time
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+import urllib
+import urlparse
+
+import couchdb
+
+from relax import codec, settings, utils
+from relax.couchdb import instrument
+
+
+class DocumentCache(object):
+    
+    """
+    A bounded, thread-safe cache of CouchDB documents.
+    
+    The cache holds at most ``max_size`` documents (by default, the
+    ``COUCHDB_DOC_CACHE_SIZE`` setting, or 1000). Documents are stored as their
+    JSON text, and decoded afresh on every hit, so callers are free to modify
+    the documents they get back.
+    """
+    
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = settings._('COUCHDB_DOC_CACHE_SIZE', 1000)
+        self.entries = utils.LRUCache(max_size)
+        # The (server_url, db_name) pairs with a running ``_changes`` follower.
+        self.followed = set()
+        # A counter per (server_url, db_name), bumped whenever documents in
+        # that database are invalidated. A fetch only caches what it got if
+        # the counter hasn't moved since it started; otherwise the document
+        # may have changed (and been evicted) while the request was in flight,
+        # and caching the old body would serve it until the next change.
+        self.generations = {}
+        self.generations_lock = threading.Lock()
+        self.local = threading.local()
+        self.logger = logging.getLogger('relax.couchdb.doccache')
+    
+    def get_connection(self, netloc):
+        """Return this thread's keep-alive connection to a server."""
+        connections = getattr(self.local, 'connections', None)
+        if connections is None:
+            connections = self.local.connections = {}
+        if netloc not in connections:
+            connections[netloc] = httplib.HTTPConnection(netloc)
+        return connections[netloc]
+    
+    def request(self, server_url, path, headers):
+        """Make a ``GET`` request, returning ``(status, headers, body)``."""
+        netloc = urlparse.urlparse(server_url)[1]
+        headers = dict(headers, Accept='application/json')
+        # A kept-alive connection may have been dropped by the server in the
+        # meantime, so try again (once) on a fresh connection.
+        for attempt in (1, 2):
+            connection = self.get_connection(netloc)
+            try:
+                start_time = time.time()
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+                instrument.record('GET', server_url + path, 0, len(body),
+                    time.time() - start_time)
+                return response.status, response, body
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                del self.local.connections[netloc]
+                if attempt == 2:
+                    raise
+    
+    def get(self, doc_id, db_name, server_url='http://127.0.0.1:5984/',
+        rev=None):
+        """Return a CouchDB document, given its ID, revision and database."""
+        server_url = server_url.rstrip('/')
+        key = (server_url, db_name, doc_id, rev)
+        cached = self.entries.get(key)
+        if cached is not None and (rev or
+            (server_url, db_name) in self.followed):
+            return couchdb.client.Document(codec.loads(cached[1]))
+        path = '/%s/%s' % (quote(db_name),
+            quote(doc_id, safe='/' if doc_id.startswith('_design/')
+                else ''))
+        headers = {}
+        if rev:
+            path += '?' + urllib.urlencode({'rev': rev})
+        elif cached is not None:
+            headers['If-None-Match'] = cached[0]
+        generation = self.generations.get((server_url, db_name), 0)
+        self.logger.debug('GET ' + server_url + path)
+        status, response, body = self.request(server_url, path, headers)
+        if status == 304:
+            return couchdb.client.Document(codec.loads(cached[1]))
+        if status == 404:
+            self.entries.pop(key)
+            raise couchdb.client.ResourceNotFound(codec.loads(body))
+        if status != 200:
+            raise couchdb.client.ServerError((status, (response.reason, body)))
+        # A given revision never changes, so it's always safe to cache.
+        if rev or generation == self.generations.get((server_url, db_name),
+            0):
+            self.entries[key] = (response.getheader('etag'), body)
+        return couchdb.client.Document(codec.loads(body))
+    
+    def invalidate(self, doc_id, db_name, server_url='http://127.0.0.1:5984/'):
+        """Forget the cached latest revision of a document."""
+        server_url = server_url.rstrip('/')
+        self.bump_generation(server_url, db_name)
+        self.entries.pop((server_url, db_name, doc_id, None))
+    
+    def bump_generation(self, server_url, db_name):
+        """Stop fetches in flight from caching a database's documents."""
+        self.generations_lock.acquire()
+        try:
+            self.generations[(server_url, db_name)] = self.generations.get(
+                (server_url, db_name), 0) + 1
+        finally:
+            self.generations_lock.release()
+    
+    def clear(self):
+        """Forget every cached document."""
+        self.entries.clear()
+    
+    def follow(self, db_name, server_url='http://127.0.0.1:5984/',
+        heartbeat=30000, retry_interval=5):
+        
+        """
+        Start a background thread which evicts documents as they change.
+        
+        The thread follows the database's continuous ``_changes`` feed. While
+        it is connected, lookups of the latest revision of documents in that
+        database are served from the cache without revalidation; if the feed
+        drops, they go back to being revalidated until it reconnects (after
+        ``retry_interval`` seconds), at which point the database's cached
+        documents are all evicted, since changes may have been missed.
+        """
+        
+        server_url = server_url.rstrip('/')
+        thread = threading.Thread(target=self.follow_changes,
+            args=(db_name, server_url, heartbeat, retry_interval))
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+    
+    def follow_changes(self, db_name, server_url, heartbeat, retry_interval):
+        netloc = urlparse.urlparse(server_url)[1]
+        db_path = '/' + quote(db_name)
+        while True:
+            connection = httplib.HTTPConnection(netloc)
+            try:
+                # Start following from the current sequence number.
+                connection.request('GET', db_path,
+                    headers={'Accept': 'application/json'})
+                since = codec.loads(connection.getresponse().read())[
+                    'update_seq']
+                connection.request('GET', db_path + '/_changes?' +
+                    urllib.urlencode({'feed': 'continuous', 'since': since,
+                        'heartbeat': heartbeat}))
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise couchdb.client.ServerError((response.status,
+                        (response.reason, response.read())))
+                self.evict_db(server_url, db_name)
+                self.followed.add((server_url, db_name))
+                for line in iter_lines(response):
+                    line = line.strip()
+                    if not line:
+                        # Just a heartbeat.
+                        continue
+                    change = codec.loads(line)
+                    if 'id' in change:
+                        self.invalidate(change['id'], db_name, server_url)
+            except Exception, exc:
+                self.logger.error('Error following changes to %r: %r' % (
+                    db_name, exc))
+            self.followed.discard((server_url, db_name))
+            connection.close()
+            time.sleep(retry_interval)
+    
+    def evict_db(self, server_url, db_name):
+        """Forget every cached latest revision of a database's documents."""
+        self.bump_generation(server_url, db_name)
+        for key in list(self.entries.links):
+            if key[:2] == (server_url, db_name) and key[3] is None:
+                self.entries.pop(key)
+
+
+def quote(string, safe=''):
+    """Quote a path segment, encoding unicode as UTF-8 first."""
+    if isinstance(string, unicode):
+        string = string.encode('utf-8')
+    return urllib.quote(string, safe=safe)
+
+def iter_lines(response):
+    
+    """
+    Yield the lines of a streaming ``httplib`` response as they arrive.
+    
+    ``HTTPResponse.read`` decodes chunked responses, but only in blocks of a
+    given size (or all at once), which is no good for a feed that never ends;
+    so chunks are decoded here, straight off the socket, and split into lines.
+    """
+    
+    fp = response.fp
+    if not response.chunked:
+        for line in iter(fp.readline, ''):
+            yield line
+        return
+    buffered = ''
+    while True:
+        size_line = fp.readline()
+        if not size_line:
+            break
+        # Chunk extensions (after a semicolon) are allowed, and ignored.
+        size = int(size_line.split(';', 1)[0].strip(), 16)
+        if not size:
+            break
+        chunk = fp.read(size)
+        # Each chunk is followed by a CRLF.
+        fp.readline()
+        lines = (buffered + chunk).split('\n')
+        buffered = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if buffered:
+        yield buffered
+
+
+cache = DocumentCache()
+
+
+def get_doc(doc_id, db_name, server_url='http://127.0.0.1:5984/', rev=None):
+    """Return a CouchDB document from the process-wide document cache."""
+    return cache.get(doc_id, db_name, server_url=server_url, rev=rev)
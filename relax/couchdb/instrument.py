@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+"""
+Per-thread recording of the HTTP requests made to CouchDB.
+
+Every request made through the shortcut server pool (and the raw HTTP
+connections in ``relax.couchdb.views`` and ``relax.couchdb.doccache``) is
+passed to ``record``. Nothing is kept unless a ``Recorder`` has been started
+for the current thread with ``start``; ``stop`` then returns it, holding the
+calls made in between. ``relax.middleware`` uses this to report on the CouchDB
+traffic caused by each Django request.
+"""
+
+import bisect
+import time
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+import urllib
+import urlparse
+
+from relax import settings
+
+
+# Upper bounds (in milliseconds) of the buckets in latency histograms; the last
+# bucket holds everything slower.
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_local = threading.local()
+
+
+class DatabaseStats(object):
+    
+    """Call counts, byte counts and latencies for requests to one database."""
+    
+    def __init__(self):
+        self.calls = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        # Maps document IDs to the number of times they were fetched singly.
+        self.doc_fetches = {}
+    
+    def add(self, method, doc_id, bytes_sent, bytes_received, seconds):
+        self.calls += 1
+        self.bytes_sent += bytes_sent
+        self.bytes_received += bytes_received
+        self.seconds += seconds
+        self.histogram[bisect.bisect_right(LATENCY_BUCKETS,
+            seconds * 1000)] += 1
+        if method == 'GET' and doc_id is not None:
+            self.doc_fetches[doc_id] = self.doc_fetches.get(doc_id, 0) + 1
+
+
+class Recorder(object):
+    
+    """The CouchDB requests made by a thread, grouped by database."""
+    
+    def __init__(self):
+        self.started = time.time()
+        # Maps (server_url, db_name) to ``DatabaseStats``.
+        self.databases = {}
+    
+    def record(self, method, url, bytes_sent, bytes_received, seconds):
+        scheme, netloc, path = urlparse.urlparse(url)[:3]
+        segments = [urllib.unquote(segment)
+            for segment in path.strip('/').split('/')]
+        db_name = segments[0] or None
+        doc_id = None
+        if len(segments) == 2 and not segments[1].startswith('_'):
+            doc_id = segments[1]
+        elif len(segments) == 3 and segments[1] == '_design':
+            doc_id = '/'.join(segments[1:])
+        key = ('%s://%s' % (scheme, netloc), db_name)
+        stats = self.databases.get(key)
+        if stats is None:
+            stats = self.databases[key] = DatabaseStats()
+        stats.add(method, doc_id, bytes_sent, bytes_received, seconds)
+    
+    @property
+    def calls(self):
+        return sum(stats.calls for stats in self.databases.values())
+    
+    @property
+    def bytes(self):
+        return sum(stats.bytes_sent + stats.bytes_received
+            for stats in self.databases.values())
+    
+    @property
+    def seconds(self):
+        return sum(stats.seconds for stats in self.databases.values())
+    
+    def n_plus_one(self, threshold=None):
+        
+        """
+        Return the databases in which documents were fetched one at a time.
+        
+        Fetching more than ``threshold`` (by default, the
+        ``COUCHDB_N_PLUS_ONE_THRESHOLD`` setting, or 10) documents singly from
+        one database usually means a loop which should be a single
+        ``get_docs`` call. The result maps ``(server_url, db_name)`` to the
+        number of single-document fetches.
+        """
+        
+        if threshold is None:
+            threshold = settings._('COUCHDB_N_PLUS_ONE_THRESHOLD', 10)
+        suspects = {}
+        for key, stats in self.databases.items():
+            fetches = sum(stats.doc_fetches.values())
+            if fetches > threshold:
+                suspects[key] = fetches
+        return suspects
+
+
+def start():
+    """Start recording the current thread's CouchDB requests."""
+    _local.recorder = Recorder()
+    return _local.recorder
+
+def stop():
+    """Stop recording the current thread's requests, returning the recorder."""
+    recorder = getattr(_local, 'recorder', None)
+    _local.recorder = None
+    return recorder
+
+def record(method, url, bytes_sent, bytes_received, seconds):
+    """Record a CouchDB request, if the current thread is being recorded."""
+    recorder = getattr(_local, 'recorder', None)
+    if recorder is not None:
+        recorder.record(method, url, bytes_sent, bytes_received, seconds)
+
+
+class InstrumentedHttp(object):
+    
+    """
+    Wraps the HTTP client of a ``couchdb.client.Server``, recording requests.
+    
+    The overhead when nothing is being recorded is a single attribute lookup
+    per request.
+    """
+    
+    def __init__(self, http):
+        self.http = http
+    
+    def __getattr__(self, attr):
+        return getattr(self.http, attr)
+    
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        if getattr(_local, 'recorder', None) is None:
+            return self.http.request(uri, method=method, body=body,
+                headers=headers, **kwargs)
+        start_time = time.time()
+        resp, content = self.http.request(uri, method=method, body=body,
+            headers=headers, **kwargs)
+        record(method, uri, len(body or ''), len(content or ''),
+            time.time() - start_time)
+        return resp, content
@@ -1,23 +1,40 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import hashlib
 import logging
+import Queue
 import re
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+import time
 import urlparse
 
 from couchdb import client
 
-from relax import DEFAULT_FORMATTER, json, settings
-from relax.couchdb import ensure_specifier_exists, specifier_to_db, shortcuts
+from relax import DEFAULT_FORMATTER, codec, settings
+from relax.couchdb import (ensure_specifier_exists, get_db_from_specifier,
+    specifier_to_db, shortcuts)
 
 
 class ReplicationError(Exception):
     
     def __init__(self, server_error_args):
-        Exception.__init__(self, 'Error in replication session.')
-        self.response_status = server_error_args[0][0]
-        self.response_reason = server_error_args[0][1][0]
-        self.response_body = json.loads(server_error_args[0][1][1])
+        # ``couchdb.client.ServerError`` has already decoded the response: its
+        # argument is the status and either ``(error, reason)`` or, if the
+        # body wasn't a JSON object, the body itself.
+        status, error = server_error_args[0]
+        if isinstance(error, tuple):
+            error, reason = error
+        else:
+            error, reason = None, error
+        Exception.__init__(self, 'Error in replication session: %s %s: %s' % (
+            status, error, reason))
+        self.response_status = status
+        self.error = error
+        self.reason = reason
 
 
 class ReplicationFailure(Exception):
@@ -28,8 +45,14 @@ class ReplicationFailure(Exception):
         self.result = result
 
 
-def replicate_existing(source_db, target_db):
-    """Replicate an existing database to another existing database."""
+def replicate_existing(source_db, target_db, doc_ids=None):
+    
+    """
+    Replicate an existing database to another existing database.
+    
+    If ``doc_ids`` is given, only the documents with those IDs are replicated.
+    """
+    
     # Get the server from which to manage the replication.
     server = shortcuts.get_server()
     logger = logging.getLogger('relax.couchdb.replicate')
@@ -37,13 +60,27 @@ def replicate_existing(source_db, target_db):
     source, target = specifier_to_db(source_db), specifier_to_db(target_db)
     logger.debug('Source DB: %s' % (source,))
     logger.debug('Target DB: %s' % (target,))
+    request = {'source': source, 'target': target}
+    if doc_ids is not None:
+        logger.debug('Replicating %d documents by ID.' % (len(doc_ids),))
+        request['doc_ids'] = doc_ids
     try:
         resp_headers, resp_body = server.resource.post(path='/_replicate',
-            content=json.dumps({'source': source, 'target': target}))
-    except couchdb.client.ServerError, exc:
+            content=codec.dumps(request))
+    except client.ServerError, exc:
         logger.error('Replication failed.')
         raise ReplicationError(exc.args)
-    result = resp_body['history'][0]
+    # Replications by document ID don't keep a history, so the statistics are
+    # in the response body itself.
+    if 'history' in resp_body:
+        result = resp_body['history'][0]
+    else:
+        result = dict(resp_body)
+        resp_body.setdefault('session_id', '')
+        resp_body.setdefault('source_last_seq', None)
+    for key in ('docs_read', 'docs_written', 'missing_checked',
+        'missing_found'):
+        result.setdefault(key, 0)
     if resp_body['ok']:
         logger.info('Replication %s... successful!' % (
             resp_body['session_id'][:6],))
@@ -92,7 +129,258 @@ def replicate_existing(source_db, target_db):
         raise ReplicationFailure(resp_headers, result)
 
 
-def replicate(source_spec, target_spec):
-    """Replicate one existing database to another (optionally existing) DB."""
+def select_doc_ids(source_spec, prefix=None, filter_function=None,
+    page_size=1000):
+    
+    """
+    Return the IDs of the documents in a database which match some criteria.
+    
+    If ``prefix`` is given, only documents whose IDs start with it are
+    selected. If ``filter_function`` is given, each document is passed to it,
+    and only those for which it returns a true value are selected; it may be a
+    callable or the dotted name of one (as resolved by the view server's
+    ``get_function``). Documents are read ``page_size`` at a time.
+    """
+    
+    if isinstance(filter_function, basestring):
+        from relax.viewserver import get_function
+        filter_function = get_function(filter_function)
+    db = get_db_from_specifier(source_spec)
+    params = {'limit': page_size}
+    if prefix:
+        params['startkey'] = codec.dumps(prefix)
+        params['endkey'] = codec.dumps(prefix + u'\ufff0')
+    if filter_function is not None:
+        params['include_docs'] = True
+    doc_ids = []
+    while True:
+        resp_headers, resp_body = db.resource.get('_all_docs', **params)
+        rows = resp_body['rows']
+        for row in rows:
+            if filter_function is None or filter_function(row['doc']):
+                doc_ids.append(row['id'])
+        if len(rows) < page_size:
+            return doc_ids
+        # Carry on from just after the last row.
+        params['startkey'] = codec.dumps(rows[-1]['id'])
+        params['skip'] = 1
+
+def replicate(source_spec, target_spec, doc_ids=None, prefix=None,
+    filter_function=None):
+    
+    """
+    Replicate one existing database to another (optionally existing) DB.
+    
+    By default the whole database is replicated. To replicate only a slice of
+    it, give either a list of ``doc_ids``, or a ``prefix`` and/or
+    ``filter_function`` to select documents with (see ``select_doc_ids``).
+    """
+    
+    ensure_specifier_exists(target_spec)
+    if prefix or filter_function is not None:
+        selected = select_doc_ids(source_spec, prefix=prefix,
+            filter_function=filter_function)
+        if doc_ids is not None:
+            wanted = set(doc_ids)
+            selected = [doc_id for doc_id in selected if doc_id in wanted]
+        doc_ids = selected
+    if doc_ids is not None and not doc_ids:
+        # Nothing to do, and an empty ``doc_ids`` might be taken to mean
+        # 'everything'.
+        return {'ok': True, 'docs_read': 0, 'docs_written': 0,
+            'missing_checked': 0, 'missing_found': 0}
+    return replicate_existing(source_spec, target_spec, doc_ids=doc_ids)
+
+
+def load_topology(topology):
+    
+    """
+    Return a list of ``(source_spec, target_spec)`` pairs from a topology.
+    
+    A topology may be given either as a list of pairs, or as a dictionary
+    mapping each source specifier to a target specifier or list of target
+    specifiers. It may also be a string, which is taken as the name of a file
+    holding the topology as JSON.
+        
+        >>> load_topology({'local:a': ['remote:b.example.com:5984:a']})
+        [('local:a', 'remote:b.example.com:5984:a')]
+    """
+    
+    if isinstance(topology, basestring):
+        fp = open(topology)
+        try:
+            topology = codec.loads(fp.read())
+        finally:
+            fp.close()
+    if isinstance(topology, dict):
+        pairs = []
+        for source_spec in sorted(topology):
+            target_specs = topology[source_spec]
+            if isinstance(target_specs, basestring):
+                target_specs = [target_specs]
+            pairs.extend((source_spec, target_spec)
+                for target_spec in target_specs)
+        return pairs
+    return [tuple(pair) for pair in topology]
+
+
+def replicate_many(pairs, workers=None):
+    
+    """
+    Replicate many source/target pairs at once, returning a combined report.
+    
+    ``pairs`` is a list of ``(source_spec, target_spec)`` pairs, or any other
+    topology accepted by ``load_topology``. They are replicated with
+    ``replicate`` by up to ``workers`` threads at a time (defaulting to the
+    ``COUCHDB_REPLICATION_WORKERS`` setting, or 4).
+    
+    The report is a dictionary holding a list of ``results``, one per pair and
+    in the same order, each with the ``source`` and ``target``, whether it was
+    ``ok``, the ``docs_read``, ``docs_written``, ``missing_checked`` and
+    ``missing_found`` counts, the time taken in ``seconds`` and any ``error``.
+    It also holds the totals of the document counts across every pair, how
+    many pairs ``succeeded`` and ``failed``, and the overall ``elapsed`` time.
+    """
+    
+    if workers is None:
+        workers = settings._('COUCHDB_REPLICATION_WORKERS', 4)
+    logger = logging.getLogger('relax.couchdb.replicate')
+    pairs = load_topology(pairs)
+    tasks = Queue.Queue()
+    for index, pair in enumerate(pairs):
+        tasks.put((index, pair))
+    results = [None] * len(pairs)
+    def worker():
+        while True:
+            try:
+                index, (source_spec, target_spec) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            summary = {'source': source_spec, 'target': target_spec,
+                'ok': False, 'docs_read': 0, 'docs_written': 0,
+                'missing_checked': 0, 'missing_found': 0, 'seconds': 0.0,
+                'error': None}
+            started = time.time()
+            try:
+                result = replicate(source_spec, target_spec)
+            except Exception, exc:
+                logger.error('Replication of %r to %r failed: %r' % (
+                    source_spec, target_spec, exc))
+                summary['error'] = repr(exc)
+            else:
+                summary['ok'] = True
+                for key in ('docs_read', 'docs_written', 'missing_checked',
+                    'missing_found'):
+                    summary[key] = result.get(key, 0)
+            summary['seconds'] = time.time() - started
+            results[index] = summary
+    started = time.time()
+    threads = [threading.Thread(target=worker)
+        for i in xrange(min(workers, len(pairs)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = {'results': results, 'elapsed': time.time() - started,
+        'succeeded': len([r for r in results if r['ok']]),
+        'failed': len([r for r in results if not r['ok']])}
+    for key in ('docs_read', 'docs_written', 'missing_checked',
+        'missing_found'):
+        report[key] = sum(r[key] for r in results)
+    logger.info('Replicated %d of %d pairs in %.2f seconds: '
+        '%d documents read, %d written.' % (report['succeeded'], len(pairs),
+            report['elapsed'], report['docs_read'], report['docs_written']))
+    return report
+
+
+def checkpoint_doc_id(source, target):
+    """Return the ID of the checkpoint document for a source/target pair."""
+    return '_local/relax-replication-' + hashlib.md5(
+        '%s\n%s' % (source, target)).hexdigest()
+
+def replicate_continuous(source_spec, target_spec, batch_size=None,
+    continuous=False, timeout=60000):
+    
+    """
+    Replicate a database in checkpointed batches, yielding progress reports.
+    
+    Rather than a single ``POST /_replicate`` which only returns once the whole
+    replication has finished, this follows the source database's ``_changes``
+    feed, replicating ``batch_size`` changes at a time (by default, the
+    ``COUCHDB_REPLICATION_BATCH_SIZE`` setting, or 500). After each batch, the
+    source sequence number reached is saved to a ``_local/`` checkpoint
+    document on the target; the next run picks up from there instead of
+    starting from scratch.
+    
+    This is a generator, which yields a dictionary after each batch, holding
+    the sequence numbers the batch ran from and to (``since`` and
+    ``source_last_seq``), the IDs of the documents in the batch (``doc_ids``)
+    and CouchDB's ``docs_read``, ``docs_written`` and ``doc_write_failures``
+    counts. By default it stops once it has caught up with the source; if
+    ``continuous`` is true, it keeps waiting (via long-polling, ``timeout``
+    milliseconds at a time) for further changes, forever.
+    """
+    
+    if batch_size is None:
+        batch_size = settings._('COUCHDB_REPLICATION_BATCH_SIZE', 500)
     ensure_specifier_exists(target_spec)
-    return replicate_existing(source_spec, target_spec)
\ No newline at end of file
+    server = shortcuts.get_server()
+    logger = logging.getLogger('relax.couchdb.replicate')
+    source, target = specifier_to_db(source_spec), specifier_to_db(target_spec)
+    source_db = get_db_from_specifier(source_spec)
+    target_db = get_db_from_specifier(target_spec)
+    # Pick up where the last run left off.
+    checkpoint_id = checkpoint_doc_id(source, target)
+    checkpoint = shortcuts.get_local_doc(target_db, checkpoint_id) or {}
+    since = checkpoint.get('source_last_seq', 0)
+    logger.info('Replicating %s to %s from sequence %s' % (source, target,
+        since))
+    while True:
+        params = {'since': since, 'limit': batch_size}
+        if continuous:
+            params.update(feed='longpoll', timeout=timeout)
+        logger.debug('GET ' + urlparse.urljoin(source_db.resource.uri + '/',
+            '_changes'))
+        resp_headers, changes = source_db.resource.get('_changes', **params)
+        if not changes['results']:
+            if not continuous:
+                logger.info('Replication of %s to %s is up to date.' % (
+                    source, target))
+                return
+            since = changes.get('last_seq', since)
+            continue
+        # Each document need only be replicated once per batch.
+        doc_ids, seen = [], set()
+        for change in changes['results']:
+            if change['id'] not in seen:
+                seen.add(change['id'])
+                doc_ids.append(change['id'])
+        last_seq = changes.get('last_seq', changes['results'][-1]['seq'])
+        logger.debug('POST ' + urlparse.urljoin(server.resource.uri,
+            '/_replicate'))
+        try:
+            resp_headers, resp_body = server.resource.post(path='/_replicate',
+                content=codec.dumps({'source': source, 'target': target,
+                    'doc_ids': doc_ids}))
+        except client.ServerError, exc:
+            logger.error('Replication failed.')
+            raise ReplicationError(exc.args)
+        if not resp_body.get('ok'):
+            logger.error('Replication of batch %s-%s failed.' % (since,
+                last_seq))
+            raise ReplicationFailure(resp_headers, resp_body)
+        # Only checkpoint once the batch has made it across.
+        shortcuts.save_local_doc(target_db, checkpoint_id,
+            {'source': source, 'target': target, 'source_last_seq': last_seq})
+        progress = {
+            'since': since,
+            'source_last_seq': last_seq,
+            'doc_ids': doc_ids,
+            'docs_read': resp_body.get('docs_read', 0),
+            'docs_written': resp_body.get('docs_written', 0),
+            'doc_write_failures': resp_body.get('doc_write_failures', 0),
+        }
+        logger.info('Replicated sequence %s-%s: %d read, %d written' % (
+            since, last_seq, progress['docs_read'], progress['docs_written']))
+        since = last_seq
+        yield progress
@@ -1,3 +1,10 @@
+import time
+import urllib
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
+
 import couchdb
 
 try:
@@ -5,29 +12,292 @@ try:
 except ImportError:
     settings = None
 
-from relax import settings
+from relax import codec, settings
+from relax.couchdb import instrument
+
+
+class ServerPool(object):
+    
+    """
+    A process-wide, thread-safe pool of CouchDB server and database handles.
+    
+    Handles are keyed by server URL (and database name), so repeated calls to
+    the shortcuts below re-use the same ``couchdb.client.Server`` instance and,
+    with it, the same keep-alive HTTP connections. The underlying HTTP client
+    is not safe to share between threads, so each thread gets its own handles;
+    those belonging to threads which have died are dropped. Each thread holds
+    at most ``max_size`` servers, evicting its least recently used first (so
+    busy threads never evict each other's handles), and drops any of its
+    servers which have been idle for more than ``max_idle`` seconds. Evicted
+    servers have their connections closed.
+    """
+    
+    def __init__(self, max_size=None, max_idle=None):
+        if max_size is None:
+            max_size = settings._('COUCHDB_POOL_SIZE', 32)
+        if max_idle is None:
+            max_idle = settings._('COUCHDB_POOL_IDLE', 300)
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        # Maps (server_url, thread) to [server, last_used, {db_name: db}].
+        self.entries = {}
+    
+    def get_entry(self, server_url):
+        key = (server_url.rstrip('/'), threading.currentThread())
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.evict(key[1], now)
+                server = couchdb.client.Server(key[0])
+                # Database instances share their server's HTTP client.
+                server.resource.http = instrument.InstrumentedHttp(
+                    server.resource.http)
+                entry = [server, now, {}]
+                self.entries[key] = entry
+            entry[1] = now
+            return entry
+        finally:
+            self.lock.release()
+    
+    def get_server(self, server_url):
+        """Return a pooled server instance for a URL."""
+        return self.get_entry(server_url)[0]
+    
+    def get_db(self, server_url, db_name):
+        """Return a pooled database instance, given its server and name."""
+        server, last_used, dbs = self.get_entry(server_url)
+        try:
+            return dbs[db_name]
+        except KeyError:
+            db = dbs[db_name] = server[db_name]
+            return db
+    
+    def evict(self, thread, now):
+        """Drop orphaned and idle handles, and make room for a new one."""
+        # This should be called with the lock held. Only handles belonging to
+        # dead threads or the current one are touched, so no connection is
+        # ever closed while another thread is using it.
+        own = []
+        for key, entry in self.entries.items():
+            if not key[1].isAlive():
+                self.discard(key)
+            elif key[1] is thread:
+                if now - entry[1] > self.max_idle:
+                    self.discard(key)
+                else:
+                    own.append(key)
+        own.sort(key=lambda key: self.entries[key][1])
+        while own and len(own) >= self.max_size:
+            self.discard(own.pop(0))
+    
+    def discard(self, key):
+        """Drop a handle, closing its keep-alive connections."""
+        server = self.entries.pop(key)[0]
+        for connection in getattr(server.resource.http, 'connections',
+            {}).values():
+            connection.close()
+    
+    def clear(self):
+        """Drop every pooled handle, closing its connections."""
+        self.lock.acquire()
+        try:
+            for key in self.entries.keys():
+                self.discard(key)
+        finally:
+            self.lock.release()
+
+
+pool = ServerPool()
+
 
+def get_resource(resource, *path):
+    """Return the resource at a path below another, quoting each segment."""
+    return couchdb.client.Resource(resource.http, '/'.join(
+        [resource.uri.rstrip('/')] +
+        [urllib.quote(segment.encode('utf-8') if isinstance(segment, unicode)
+            else segment, safe='') for segment in path]))
 
 def get_server(server_url='http://127.0.0.1:5984/'):
     """Return a CouchDB server instance based on Django project settings."""
-    return couchdb.client.Server(
+    return pool.get_server(
         server_url if server_url else settings._('COUCHDB_SERVER'))
 
 def get_db(db_name, server_url='http://127.0.0.1:5984/'):
     """Return a CouchDB database instance, given its name."""
-    return get_server(server_url)[db_name]
+    return pool.get_db(
+        server_url if server_url else settings._('COUCHDB_SERVER'), db_name)
 
-def get_doc(doc_id, db_name, server_url='http://127.0.0.1:5984/', rev=None):
-    """Return a CouchDB document, given its ID, revision and database name."""
-    db = get_server(server_url)[db_name]
+def get_doc(doc_id, db_name, server_url='http://127.0.0.1:5984/', rev=None,
+    cached=None):
+    
+    """
+    Return a CouchDB document, given its ID, revision and database name.
+    
+    If ``cached`` is true (by default, the ``COUCHDB_CACHE_DOCS`` setting, or
+    ``False``), the document is fetched through the process-wide document
+    cache in ``relax.couchdb.doccache``.
+    """
+    
+    if cached is None:
+        cached = settings._('COUCHDB_CACHE_DOCS', False)
+    if cached:
+        from relax.couchdb import doccache
+        return doccache.get_doc(doc_id, db_name, server_url=server_url,
+            rev=rev)
+    db = get_db(db_name, server_url)
     if rev:
         headers, response = db.resource.get(doc_id, rev=rev)
         return couchdb.client.Document(response)
     return db[doc_id]
 
+def chunks(items, chunk_size):
+    """Yield successive lists of at most ``chunk_size`` items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def get_docs(doc_ids, db_name, server_url='http://127.0.0.1:5984/',
+    chunk_size=None):
+    
+    """
+    Yield many CouchDB documents, given their IDs and database name.
+    
+    Documents are fetched ``chunk_size`` at a time (by default, the
+    ``COUCHDB_BULK_CHUNK_SIZE`` setting, or 500) with a single ``POST`` to
+    ``_all_docs`` per chunk, and yielded in the same order as ``doc_ids`` as
+    each chunk arrives. ``None`` is yielded in place of documents which are
+    missing or deleted.
+    """
+    
+    if chunk_size is None:
+        chunk_size = settings._('COUCHDB_BULK_CHUNK_SIZE', 500)
+    db = get_db(db_name, server_url)
+    for chunk in chunks(doc_ids, chunk_size):
+        resp_headers, resp_body = db.resource.post('_all_docs',
+            content=codec.dumps({'keys': chunk}),
+            headers={'Content-Type': 'application/json'}, include_docs=True)
+        for row in resp_body['rows']:
+            if row.get('doc'):
+                yield couchdb.client.Document(row['doc'])
+            else:
+                yield None
+
+def save_docs(docs, db_name, server_url='http://127.0.0.1:5984/',
+    chunk_size=None):
+    
+    """
+    Create or update many CouchDB documents, returning a result for each.
+    
+    Documents are written ``chunk_size`` at a time (as for ``get_docs``) with a
+    single ``POST`` to ``_bulk_docs`` per chunk. The result for each document
+    is a dictionary holding its ``id`` and either its new ``rev``, or an
+    ``error`` (such as ``'conflict'``) and a ``reason``; successfully-saved
+    documents also have their ``_id`` and ``_rev`` updated in place.
+    """
+    
+    if chunk_size is None:
+        chunk_size = settings._('COUCHDB_BULK_CHUNK_SIZE', 500)
+    db = get_db(db_name, server_url)
+    results = []
+    for chunk in chunks(docs, chunk_size):
+        resp_headers, resp_body = db.resource.post('_bulk_docs',
+            content=codec.dumps({'docs': chunk}),
+            headers={'Content-Type': 'application/json'})
+        # Older versions of CouchDB wrap the results up in an object.
+        if isinstance(resp_body, dict):
+            resp_body = resp_body.get('new_revs', [])
+        for doc, result in zip(chunk, resp_body):
+            if 'error' not in result:
+                doc['_id'], doc['_rev'] = result['id'], result['rev']
+            results.append(result)
+    return results
+
+def get_revs(doc_ids, db_name, server_url='http://127.0.0.1:5984/',
+    chunk_size=None):
+    
+    """
+    Yield the current revisions of many CouchDB documents.
+    
+    This works like ``get_docs``, but without fetching the documents' bodies;
+    ``None`` is yielded for documents which are missing or deleted (and so can
+    be created without a revision).
+    """
+    
+    if chunk_size is None:
+        chunk_size = settings._('COUCHDB_BULK_CHUNK_SIZE', 500)
+    db = get_db(db_name, server_url)
+    for chunk in chunks(doc_ids, chunk_size):
+        resp_headers, resp_body = db.resource.post('_all_docs',
+            content=codec.dumps({'keys': chunk}),
+            headers={'Content-Type': 'application/json'})
+        for row in resp_body['rows']:
+            value = row.get('value') or {}
+            if value.get('deleted'):
+                yield None
+            else:
+                yield value.get('rev')
+
+def get_conflicts(results):
+    """Return the IDs of the documents which ``save_docs`` had conflicts on."""
+    return [result['id'] for result in results
+        if result.get('error') == 'conflict']
+
 def get_or_create_db(db_name, server_url='http://127.0.0.1:5984/'):
     """Return an (optionally existing) CouchDB database instance."""
     server = get_server(server_url)
     if db_name in server:
-        return server[db_name]
-    return server.create(db_name)
\ No newline at end of file
+        return get_db(db_name, server_url)
+    return server.create(db_name)
+
+def get_local_doc(db, doc_id):
+    """Return a ``_local/`` document from a database, or ``None``."""
+    try:
+        resp_headers, doc = db.resource.get(doc_id)
+    except couchdb.client.ResourceNotFound:
+        return None
+    return doc
+
+def save_local_doc(db, doc_id, doc):
+    """Create or update a ``_local/`` document, given its new contents."""
+    existing = get_local_doc(db, doc_id)
+    doc = dict(doc)
+    if existing and '_rev' in existing:
+        doc['_rev'] = existing['_rev']
+    resp_headers, resp_body = db.resource.put(doc_id,
+        content=codec.dumps(doc))
+    return resp_body
+
+def ensure_design_doc(db, doc_id, doc):
+    
+    """
+    Make sure a design document exists with the given contents.
+    
+    The design document is only written if it's missing or differs from
+    ``doc``, so this is cheap enough to call whenever a database is first
+    used. Returns ``True`` if the document was written.
+    """
+    
+    try:
+        resp_headers, existing = db.resource.get(doc_id)
+    except couchdb.client.ResourceNotFound:
+        existing = None
+    doc = dict(doc)
+    if existing is not None:
+        if dict((key, value) for (key, value) in existing.items()
+            if not key.startswith('_')) == doc:
+            return False
+        doc['_rev'] = existing['_rev']
+    try:
+        db.resource.put(doc_id, content=codec.dumps(doc))
+    except couchdb.client.ResourceConflict:
+        # Someone else got there first.
+        return False
+    return True
\ No newline at end of file
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+import httplib
+import logging
+import time
+import urllib
+import urlparse
+
+from relax import codec, settings
+from relax.couchdb import instrument, parse_specifier
+
+
+# Query parameters whose values are always JSON, even if they're strings.
+JSON_PARAMS = ('key', 'keys', 'startkey', 'endkey', 'start_key', 'end_key')
+
+
+class ViewError(Exception):
+    
+    def __init__(self, status, reason, body):
+        Exception.__init__(self, 'View query failed: %s %s' % (status, reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+def encode_params(params):
+    """Encode a dictionary of view query parameters as a query string."""
+    query = []
+    for name, value in sorted(params.items()):
+        if name in JSON_PARAMS or not isinstance(value, basestring):
+            value = codec.dumps(value)
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        query.append((name, value))
+    return urllib.urlencode(query)
+
+class CountingReader(object):
+    
+    """Wraps an HTTP response, counting the bytes read from it."""
+    
+    def __init__(self, response):
+        self.response = response
+        self.bytes_read = 0
+    
+    def read(self, size=None):
+        if size is None:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+def iter_lines(response, read_size=8192):
+    """Yield the lines of an HTTP response body as they arrive."""
+    remainder = ''
+    while True:
+        data = response.read(read_size)
+        if not data:
+            break
+        lines = (remainder + data).split('\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line
+    if remainder:
+        yield remainder
+
+def iter_rows(response):
+    
+    """
+    Incrementally decode the rows of a view response.
+    
+    CouchDB writes each row of a view result on a line of its own, between a
+    header line (ending in ``"rows":[``) and a footer line (``]}``), so rows
+    can be decoded one at a time as they come off the socket. If the response
+    isn't laid out like this, it's decoded in one go instead.
+    """
+    
+    lines = iter_lines(response)
+    for header in lines:
+        if header.strip():
+            break
+    else:
+        return
+    if not header.rstrip().endswith('['):
+        # Not one row per line; fall back to decoding the whole thing.
+        body = codec.loads(header + '\n' + '\n'.join(lines))
+        for row in body.get('rows', []):
+            yield row
+        return
+    for line in lines:
+        line = line.strip().rstrip(',')
+        if line.startswith('{'):
+            yield codec.loads(line)
+
+def iterview(db_spec, view_name=None, page_size=None, **params):
+    
+    """
+    Lazily yield the rows of a view, paging through it with constant memory.
+    
+    ``view_name`` should be given as ``'design_name/view_name'``; if it is
+    ``None``, the rows of ``_all_docs`` are yielded instead. Any other keyword
+    arguments are passed on as query parameters (``startkey``, ``endkey``,
+    ``include_docs``, ``descending``, ``limit`` and so on); keys are always
+    JSON-encoded, as are any other values which aren't strings.
+    
+    Rows are fetched ``page_size`` at a time (by default, the
+    ``COUCHDB_VIEW_PAGE_SIZE`` setting, or 1000), with each page starting from
+    the ``startkey``/``startkey_docid`` of the row after the last. Each page is
+    decoded row by row as it streams in, and rows are yielded as soon as they
+    are decoded, so neither the whole result nor even a whole page is ever held
+    in memory at once.
+    """
+    
+    if page_size is None:
+        page_size = settings._('COUCHDB_VIEW_PAGE_SIZE', 1000)
+    logger = logging.getLogger('relax.couchdb.views')
+    spec = parse_specifier(db_spec)
+    scheme, netloc = urlparse.urlparse(spec.server_url)[:2]
+    path = '/' + urllib.quote(spec.database, safe='')
+    if view_name is None:
+        path += '/_all_docs'
+    else:
+        design_name, view_name = view_name.split('/', 1)
+        path += '/_design/%s/_view/%s' % (urllib.quote(design_name, safe=''),
+            urllib.quote(view_name, safe=''))
+    remaining = params.pop('limit', None)
+    connection = httplib.HTTPConnection(netloc)
+    try:
+        while remaining is None or remaining > 0:
+            # Ask for one row more than we want; it tells us where the next
+            # page starts.
+            limit = page_size
+            if remaining is not None:
+                limit = min(limit, remaining)
+            params['limit'] = limit + 1
+            url = path + '?' + encode_params(params)
+            logger.debug('GET ' + spec.server_url + url)
+            start_time = time.time()
+            connection.request('GET', url,
+                headers={'Accept': 'application/json'})
+            response = connection.getresponse()
+            if response.status != 200:
+                raise ViewError(response.status, response.reason,
+                    response.read())
+            reader = CountingReader(response)
+            next_row = None
+            count = 0
+            for row in iter_rows(reader):
+                if count == limit:
+                    next_row = row
+                    continue
+                count += 1
+                yield row
+            # This includes the time spent by the caller on each row, but
+            # there's no other way to time a streamed response.
+            instrument.record('GET', spec.server_url + url, 0,
+                reader.bytes_read, time.time() - start_time)
+            if remaining is not None:
+                remaining -= count
+            if next_row is None:
+                return
+            params.pop('skip', None)
+            params['startkey'] = next_row['key']
+            if 'id' in next_row:
+                params['startkey_docid'] = next_row['id']
+    finally:
+        connection.close()
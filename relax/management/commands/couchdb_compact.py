@@ -17,15 +17,40 @@ class Command(BaseCommand):
             help='Compact all CouchDB databases in the configured server.'),
         make_option('-s', '--sync',
             dest='sync', action='store_true', default=False,
-            help='Run compactions synchronously.'))
+            help='Run compactions synchronously.'),
+        make_option('-j', '--jobs',
+            dest='jobs', type='int', default=None,
+            help='Number of synchronous compactions to run at once.'),
+        make_option('-t', '--threshold',
+            dest='threshold', type='float', default=None,
+            help='Only compact databases at least this fragmented (0-1).'),
+        make_option('-f', '--force',
+            dest='force', action='store_true', default=False,
+            help='Compact databases even if they are not worth compacting.'),
+        make_option('-n', '--dry-run',
+            dest='dry_run', action='store_true', default=False,
+            help='Report which databases would be compacted, and why.'),
+        make_option('--views',
+            dest='views', action='store_true', default=False,
+            help='Compact the view indexes of each design document too.'),
+        make_option('-w', '--warm',
+            dest='warm', action='store_true', default=False,
+            help='Query the views afterwards, to warm up their indexes.'))
     
     help = 'Compact CouchDB databases.'
-    args = '[-s] [--compact-all | db_spec1[, db_spec2, ...]]'
+    args = ('[-s [-j N] [-w]] [-t T] [-f] [-n] [--views] '
+        '[--compact-all | db_spec1[, db_spec2, ...]]')
     
     def handle(self, *db_specs, **options):
         # Process options and arguments
         compact_all = options.get('compact_all', False)
         sync = options.get('sync', False)
+        jobs = options.get('jobs', None)
+        threshold = options.get('threshold', None)
+        force = options.get('force', False)
+        dry_run = options.get('dry_run', False)
+        views = options.get('views', False)
+        warm = options.get('warm', False)
         if (not db_specs) and compact_all:
             local_server = shortcuts.get_server()
             db_specs = map(db_to_specifier, list(local_server))
@@ -37,22 +62,52 @@ class Command(BaseCommand):
         if settings._('DEBUG', True):
             logger.setLevel(logging.DEBUG)
         logger.propagate = False
+        # Report on the databases, without compacting anything.
+        if dry_run:
+            for db_spec in db_specs:
+                report = compact.compaction_report(db_spec,
+                    threshold=threshold)
+                if force or report['compact']:
+                    verdict = 'compact'
+                else:
+                    verdict = 'skip'
+                print '%s %r: %s on disk, %s fragmented (%s)' % (
+                    verdict, db_spec, compact.repr_bytes(report['disk_size']),
+                    '%.1f%%' % (report['fragmentation'] * 100,),
+                    report['reason'])
+            return
         # Begin compaction
-        for db_spec in db_specs:
-            logger.debug('Compacting %r' % (db_spec,))
-            if sync:
-                try:
-                    result = compact.compact(db_spec, poll_interval=0.4)
-                except compact.CompactionError:
-                    result = False
-                if not result:
+        if sync:
+            # Synchronous compactions are run through the scheduler, a few at
+            # a time, biggest first.
+            results = compact.compact_many(db_specs, concurrency=jobs,
+                poll_interval=0.4, threshold=threshold, force=force,
+                views=views, warm=warm)
+            for db_spec in db_specs:
+                if not results.get(db_spec):
                     logger.error('Error compacting %r' % (db_spec,))
                 else:
                     logger.info('Successfully compacted %r' % (db_spec,))
+            return
+        for db_spec in db_specs:
+            logger.debug('Compacting %r' % (db_spec,))
+            try:
+                check_completed = compact.compact(db_spec,
+                    threshold=threshold, force=force)
+            except compact.CompactionError:
+                logger.error('Error compacting %r' % (db_spec,))
             else:
+                logger.info('Successfully began compaction of %r', db_spec)
+            # The view compactions are started alongside, since nothing will
+            # be waiting around to start them afterwards.
+            if views:
                 try:
-                    check_completed = compact.compact(db_spec)
-                except compact.CompactionError:
-                    logger.error('Error compacting %r' % (db_spec,))
+                    compact.compact_views(db_spec)
+                except Exception, exc:
+                    logger.error('Error compacting views of %r: %r' % (
+                        db_spec, exc))
                 else:
-                    logger.info('Successfully began compaction of %r', db_spec)
\ No newline at end of file
+                    logger.info('Successfully began view compaction of %r',
+                        db_spec)
+        if warm:
+            logger.warning('Views can only be warmed with --sync.')
\ No newline at end of file
@@ -6,19 +6,50 @@ import os
 import re
 
 from django.conf import settings
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError, make_option
 
-from relax import DEFAULT_FORMATTER, json, settings
+from relax import DEFAULT_FORMATTER, codec, settings
 from relax.couchdb import replicate, shortcuts
 from relax.utils import logrotate
 
 
 class Command(BaseCommand):
     
+    option_list = BaseCommand.option_list + (
+        make_option('-b', '--batched',
+            dest='batched', action='store_true', default=False,
+            help=('Replicate in checkpointed batches, resuming from the last '
+                'checkpoint.')),
+        make_option('-c', '--continuous',
+            dest='continuous', action='store_true', default=False,
+            help='Keep following the source for changes (implies -b).'),
+        make_option('--batch-size',
+            dest='batch_size', type='int', default=None,
+            help='Number of changes to replicate per batch.'),
+        make_option('-t', '--topology',
+            dest='topology', default=None,
+            help=('Replicate every pair in a JSON topology file (or, with no '
+                'arguments, the COUCHDB_REPLICATION_TOPOLOGY setting).')),
+        make_option('-w', '--workers',
+            dest='workers', type='int', default=None,
+            help='Number of pairs to replicate at once, with a topology.'),
+        make_option('--doc-ids',
+            dest='doc_ids', default=None,
+            help='Only replicate these (comma-separated) document IDs.'),
+        make_option('--prefix',
+            dest='prefix', default=None,
+            help='Only replicate documents whose IDs start with this.'),
+        make_option('--filter',
+            dest='filter_function', default=None,
+            help=('Only replicate documents for which this function '
+                '(e.g. myapp.filters.is_public) returns true.')))
+    
     help = 'Replicate CouchDB databases.'
-    args = 'source_specifier target_specifier'
-        
-    def handle(self, source_spec, target_spec, *args, **options):
+    args = ('[-b | -c] [--batch-size N] [--doc-ids ID,...] [--prefix P] '
+        '[--filter F] source_specifier target_specifier | '
+        '[-t topology_file] [-w N]')
+    
+    def handle(self, *args, **options):
         # Set up logger
         logger = logging.getLogger('relax.couchdb.replicate')
         handler = logging.StreamHandler()
@@ -27,10 +58,54 @@ class Command(BaseCommand):
         if settings._('DEBUG', True):
             logger.setLevel(logging.DEBUG)
         logger.propagate = False
+        # Only a single, one-off replication can be limited to some documents;
+        # anything else would silently replicate the whole database.
+        selection = [option for option, name in (('--doc-ids', 'doc_ids'),
+            ('--prefix', 'prefix'), ('--filter', 'filter_function'))
+            if options.get(name, None) is not None]
+        modes = [option for option, name in (('-b', 'batched'),
+            ('-c', 'continuous'), ('-t', 'topology')) if options.get(name)]
+        if selection and (modes or not args):
+            raise CommandError('%s cannot be combined with %s.' % (
+                '/'.join(selection), '/'.join(modes) or 'a topology'))
+        # Replicate a whole topology of databases.
+        topology = options.get('topology', None)
+        if topology or not args:
+            if not topology:
+                topology = settings._('COUCHDB_REPLICATION_TOPOLOGY')
+            logger.info('Beginning replication of topology.')
+            report = replicate.replicate_many(topology,
+                workers=options.get('workers', None))
+            for result in report['results']:
+                if result['ok']:
+                    logger.info('%s -> %s: %d read, %d written, %.2fs' % (
+                        result['source'], result['target'],
+                        result['docs_read'], result['docs_written'],
+                        result['seconds']))
+                else:
+                    logger.error('%s -> %s: %s' % (result['source'],
+                        result['target'], result['error']))
+            return
+        if len(args) != 2:
+            raise CommandError('Expected a source and a target specifier.')
+        source_spec, target_spec = args
         # Replicate the databases
         logger.info('Beginning replication.')
+        continuous = options.get('continuous', False)
+        if continuous or options.get('batched', False):
+            # Progress is logged by ``replicate_continuous`` itself.
+            for progress in replicate.replicate_continuous(source_spec,
+                target_spec, batch_size=options.get('batch_size', None),
+                continuous=continuous):
+                pass
+            return
+        doc_ids = options.get('doc_ids', None)
+        if doc_ids is not None:
+            doc_ids = [doc_id for doc_id in doc_ids.split(',') if doc_id]
         try:
-            replicate.replicate(source_spec, target_spec)
+            replicate.replicate(source_spec, target_spec, doc_ids=doc_ids,
+                prefix=options.get('prefix', None),
+                filter_function=options.get('filter_function', None))
         except replicate.ReplicationFailure, exc:
             # If there was an error, write the error output from CouchDB to a
             # rotated replication log file.
@@ -40,10 +115,10 @@ class Command(BaseCommand):
             fp = open(log_filename, 'w')
             try:
                 fp.write('response_headers = %s' % (
-                    json.dumps(exc.response_headers),))
+                    codec.dumps(exc.response_headers),))
                 fp.write(os.linesep * 2)
                 fp.write('result = %s' % (
-                    json.dumps(exc.response_headers),))
+                    codec.dumps(exc.response_headers),))
                 fp.write(os.linesep)
             finally:
                 fp.close()
\ No newline at end of file
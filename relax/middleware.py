@@ -1 +1,69 @@
 # -*- coding: utf-8 -*-
+
+import logging
+
+from relax import settings
+from relax.couchdb import instrument
+
+
+class CouchDBInstrumentationMiddleware(object):
+    
+    """
+    Report on the CouchDB requests made while handling each Django request.
+    
+    Add ``'relax.middleware.CouchDBInstrumentationMiddleware'`` to the top of
+    ``MIDDLEWARE_CLASSES``. For each request, a summary of the CouchDB calls,
+    bytes and time (per database, with a latency histogram) is logged to the
+    ``relax.middleware`` logger at debug level, and pages which fetched many
+    documents one at a time from the same database (the N+1 pattern) are
+    logged as warnings.
+    
+    If the ``COUCHDB_INSTRUMENT_HEADERS`` setting is true (by default, it takes
+    the value of ``DEBUG``), the totals are also added to each response as
+    ``X-CouchDB-Calls``, ``X-CouchDB-Bytes`` and ``X-CouchDB-Time`` (in
+    milliseconds) headers.
+    """
+    
+    def __init__(self):
+        self.logger = logging.getLogger('relax.middleware')
+    
+    def process_request(self, request):
+        instrument.start()
+    
+    def process_response(self, request, response):
+        recorder = instrument.stop()
+        if recorder is None:
+            # ``process_request`` was never called (e.g. because an earlier
+            # middleware returned a response).
+            return response
+        if settings._('COUCHDB_INSTRUMENT_HEADERS',
+            settings._('DEBUG', False)):
+            response['X-CouchDB-Calls'] = str(recorder.calls)
+            response['X-CouchDB-Bytes'] = str(recorder.bytes)
+            response['X-CouchDB-Time'] = '%.1f' % (recorder.seconds * 1000,)
+        if recorder.calls:
+            self.log_summary(request, recorder)
+        return response
+    
+    def log_summary(self, request, recorder):
+        self.logger.debug('%s %s: %d CouchDB calls, %d bytes, %.1fms' % (
+            request.method, request.path, recorder.calls, recorder.bytes,
+            recorder.seconds * 1000))
+        for (server_url, db_name), stats in sorted(
+            recorder.databases.items()):
+            histogram = ' '.join('<%dms:%d' % (bound, count)
+                for (bound, count) in zip(instrument.LATENCY_BUCKETS,
+                    stats.histogram) if count)
+            if stats.histogram[-1]:
+                histogram += ' >=%dms:%d' % (instrument.LATENCY_BUCKETS[-1],
+                    stats.histogram[-1])
+            self.logger.debug('  %s/%s: %d calls, %d bytes sent, '
+                '%d bytes received, %.1fms [%s]' % (server_url, db_name or '',
+                    stats.calls, stats.bytes_sent, stats.bytes_received,
+                    stats.seconds * 1000, histogram.strip()))
+        for (server_url, db_name), fetches in sorted(
+            recorder.n_plus_one().items()):
+            self.logger.warning('%s %s: %d documents fetched one at a time '
+                'from %s/%s; consider relax.couchdb.shortcuts.get_docs' % (
+                    request.method, request.path, fetches, server_url,
+                    db_name))
@@ -1 +1,190 @@
 # -*- coding: utf-8 -*-
+
+"""
+A Django session engine which stores sessions in a CouchDB database.
+
+To use it, set ``SESSION_ENGINE = 'relax.session'``. Sessions are stored in
+the database given by the ``COUCHDB_SESSION_DB`` specifier (by default,
+``'local:sessions'``), one document per session, so they can be replicated
+between servers.
+"""
+
+# Otherwise ``import couchdb`` would pick up ``relax.couchdb``.
+from __future__ import absolute_import
+
+import logging
+import time
+
+import couchdb
+from django.contrib.sessions.backends.base import SessionBase, CreateError
+
+from relax import codec, settings
+from relax.couchdb import parse_specifier, shortcuts
+from relax.couchdb.views import iterview
+
+
+DESIGN_DOC_ID = '_design/relax_sessions'
+DESIGN_DOC = {
+    'language': 'javascript',
+    'views': {
+        'expiry': {
+            'map': ('function(doc) { if (doc.expire_date) '
+                'emit(doc.expire_date, doc._rev); }'),
+        },
+    },
+}
+
+# The specifiers of the session databases which are known to be set up.
+_prepared = set()
+
+
+def get_spec():
+    """Return the ``DatabaseSpec`` of the session database, setting it up."""
+    spec = parse_specifier(settings._('COUCHDB_SESSION_DB', 'local:sessions'))
+    if spec not in _prepared:
+        spec.ensure_exists()
+        shortcuts.ensure_design_doc(spec.get_db(), DESIGN_DOC_ID, DESIGN_DOC)
+        _prepared.add(spec)
+    return spec
+
+
+class SessionStore(SessionBase):
+    
+    """
+    A session store which keeps each session in a CouchDB document.
+    
+    Writes are kept to a minimum: the session's revision is remembered from
+    when it was loaded, so an update is a single ``PUT``; and a save which
+    wouldn't change the stored session data is skipped, unless the stored
+    expiry date is more than ``COUCHDB_SESSION_EXPIRY_SLACK`` seconds (by
+    default, 60) out of date. This means repeated saves within a request (or
+    saving on every request) only write when something has really changed.
+    """
+    
+    def __init__(self, session_key=None):
+        SessionBase.__init__(self, session_key)
+        self.spec = get_spec()
+        # The revision, and (session_data, expire_date) as last read from or
+        # written to the database.
+        self._rev = None
+        self._stored = None
+    
+    def make_doc_id(self, session_key):
+        return 'session:' + session_key
+    
+    def load(self):
+        try:
+            resp_headers, doc = self.spec.get_db().resource.get(
+                self.make_doc_id(self.session_key))
+        except couchdb.client.ResourceNotFound:
+            doc = None
+        if doc is None or doc.get('expire_date', 0) <= time.time():
+            self.create()
+            return {}
+        self._rev = doc['_rev']
+        self._stored = (doc['session_data'], doc['expire_date'])
+        return self.decode(doc['session_data'])
+    
+    def exists(self, session_key):
+        revs = shortcuts.get_revs([self.make_doc_id(session_key)],
+            self.spec.database, self.spec.server_url)
+        return list(revs)[0] is not None
+    
+    def create(self):
+        while True:
+            self.session_key = self._get_new_session_key()
+            try:
+                self.save(must_create=True)
+            except CreateError:
+                continue
+            self.modified = True
+            self._session_cache = {}
+            return
+    
+    def save(self, must_create=False):
+        session_data = self.encode(self._get_session(no_load=must_create))
+        expire_date = time.mktime(self.get_expiry_date().timetuple())
+        if must_create:
+            self._rev = self._stored = None
+        elif self._stored is not None:
+            stored_data, stored_expiry = self._stored
+            slack = settings._('COUCHDB_SESSION_EXPIRY_SLACK', 60)
+            if (session_data == stored_data and
+                abs(expire_date - stored_expiry) < slack):
+                return
+        doc = {'session_data': session_data, 'expire_date': expire_date}
+        if self._rev is not None:
+            doc['_rev'] = self._rev
+        db = self.spec.get_db()
+        doc_id = self.make_doc_id(self.session_key)
+        try:
+            resp_headers, result = db.resource.put(doc_id,
+                content=codec.dumps(doc))
+        except couchdb.client.ResourceConflict:
+            if must_create:
+                raise CreateError
+            # Another request saved this session since we loaded it; as with
+            # Django's own backends, the last write wins.
+            doc['_rev'] = list(shortcuts.get_revs([doc_id], self.spec.database,
+                self.spec.server_url))[0]
+            if doc['_rev'] is None:
+                del doc['_rev']
+            resp_headers, result = db.resource.put(doc_id,
+                content=codec.dumps(doc))
+        self._rev = result['rev']
+        self._stored = (session_data, expire_date)
+    
+    def delete(self, session_key=None):
+        if session_key is None:
+            if self.session_key is None:
+                return
+            session_key = self.session_key
+        doc_id = self.make_doc_id(session_key)
+        if session_key == self.session_key and self._rev is not None:
+            rev = self._rev
+        else:
+            rev = list(shortcuts.get_revs([doc_id], self.spec.database,
+                self.spec.server_url))[0]
+        db = self.spec.get_db()
+        if rev is not None:
+            try:
+                db.resource.delete(doc_id, rev=rev)
+            except couchdb.client.ResourceNotFound:
+                pass
+            except couchdb.client.ResourceConflict:
+                # Another request saved this session since we loaded it; it
+                # still has to go (e.g. on logout), so delete the latest
+                # revision instead.
+                rev = list(shortcuts.get_revs([doc_id], self.spec.database,
+                    self.spec.server_url))[0]
+                if rev is not None:
+                    try:
+                        db.resource.delete(doc_id, rev=rev)
+                    except couchdb.client.ResourceNotFound:
+                        pass
+        if session_key == self.session_key:
+            self._rev = self._stored = None
+
+
+def clear_expired():
+    
+    """
+    Delete every expired session, returning how many there were.
+    
+    Expired sessions are found with a range query on a view keyed by expiry
+    date (so the whole database is never scanned), and deleted in bulk.
+    """
+    
+    spec = get_spec()
+    chunk_size = settings._('COUCHDB_BULK_CHUNK_SIZE', 500)
+    rows = iterview(spec.specifier, 'relax_sessions/expiry',
+        page_size=chunk_size, endkey=time.time())
+    count = 0
+    for chunk in shortcuts.chunks(rows, chunk_size):
+        shortcuts.save_docs([{'_id': row['id'], '_rev': row['value'],
+            '_deleted': True} for row in chunk], spec.database,
+            spec.server_url)
+        count += len(chunk)
+    logging.getLogger('relax.session').debug(
+        'Cleared %d expired sessions from %r' % (count, spec.specifier))
+    return count
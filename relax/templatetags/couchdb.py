@@ -5,7 +5,7 @@ import re
 from django import template
 from django.template.defaultfilters import stringfilter
 
-from relax import json, settings
+from relax import codec, settings
 
 
 register = template.Library()
@@ -57,11 +57,11 @@ def get_setting(parser, token):
             setting_name, default_value, var_name = match.groups()
             # The default value should be specified in JSON format. This makes
             # things considerably more secure than just using eval().
-            default_value = json.loads(default_value)
+            default_value = codec.loads(default_value)
             return SettingNode(setting_name, var_name=var_name,
                 default_value=default_value)
         setting_name, default_value = match.groups()
-        default_value = json.loads(default_value)
+        default_value = codec.loads(default_value)
         return SettingNode(setting_name, default_value=default_value)
     setting_name = match.groups()[0]
     return SettingNode(setting_name)
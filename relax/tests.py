@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+import httplib
+import StringIO
+import time
+import unittest
+import urlparse
+
+from relax import codec, utils, viewserver
+from relax.couchdb import doccache, replicate, shortcuts
+from relax.viewserver import ViewServerProtocol
+
+from benchmarks.fakecouch import FakeCouchServer
+
+
+def wait_for(condition, timeout=5):
+    """Poll until a condition is true, returning whether it ever was."""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class FakeCouchTestCase(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = FakeCouchServer()
+        self.server.start()
+        self.server.dbs['db'] = {'doc': {'_id': 'doc', '_rev': '1-a', 'n': 1}}
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def put_doc(self, db_name, doc):
+        connection = httplib.HTTPConnection(
+            urlparse.urlparse(self.server.url)[1])
+        try:
+            connection.request('PUT', '/%s/%s' % (db_name, doc['_id']),
+                codec.dumps(doc), {'Content-Type': 'application/json'})
+            return codec.loads(connection.getresponse().read())
+        finally:
+            connection.close()
+
+
+class ViewServerProtocolTest(unittest.TestCase):
+    
+    def test_non_list_commands_are_reported(self):
+        protocol = ViewServerProtocol()
+        protocol.handle_lines(['5\n', '{"a": 1}\n', '[]\n', '["reset"]\n'])
+        output = protocol.take_output().splitlines()
+        self.assertEqual(len(output), 4)
+        for line in output[:3]:
+            self.assert_(line.startswith('ValueError('), line)
+        self.assertEqual(output[3], 'true')
+    
+    def test_builtin_reducers_keep_integers_exact(self):
+        protocol = ViewServerProtocol()
+        big = 10 ** 23 - 1
+        protocol.handle_lines([codec.dumps(['reduce', ['_sum', '_stats'],
+            [[['a', 'a'], big], [['b', 'b'], 1]]]) + '\n',
+            codec.dumps(['reduce', ['_sum'],
+            [[['a', 'a'], [1, 2]], [['b', 'b'], [3, 4]]]]) + '\n'])
+        output = [codec.loads(line)
+            for line in protocol.take_output().splitlines()]
+        self.assertEqual(output[0][1][0], 10 ** 23)
+        self.assertEqual(output[0][1][1]['sumsqr'], big * big + 1)
+        self.assertEqual(output[1], [True, [[4, 6]]])
+        self.assert_(isinstance(output[1][1][0][0], int))
+    
+    def test_stats_always_replies(self):
+        protocol = ViewServerProtocol()
+        protocol.handle_lines(['["stats"]\n'])
+        self.assertEqual(codec.loads(protocol.take_output()),
+            {'enabled': viewserver.stats.enabled})
+
+
+class LRUCacheTest(unittest.TestCase):
+    
+    def test_zero_or_negative_size_stores_nothing(self):
+        for max_size in (0, -1):
+            cache = utils.LRUCache(max_size)
+            cache['a'] = 1
+            self.assertEqual(len(cache), 0)
+            self.assertEqual(cache.get('a'), None)
+    
+    def test_size_one_keeps_the_latest_key(self):
+        cache = utils.LRUCache(1)
+        cache['a'] = 1
+        cache['b'] = 2
+        self.assertEqual((cache.get('a'), cache.get('b')), (None, 2))
+        cache['b'] = 3
+        self.assertEqual((len(cache), cache['b']), (1, 3))
+        del cache['b']
+        cache['c'] = 4
+        self.assertEqual(cache.links.keys(), ['c'])
+    
+    def test_least_recently_used_key_is_evicted(self):
+        cache = utils.LRUCache(2)
+        cache['a'], cache['b'] = 1, 2
+        cache['a']
+        cache['c'] = 3
+        self.assertEqual(sorted(cache.links), ['a', 'c'])
+
+
+class FakeResponse(object):
+    
+    def __init__(self, data, chunked):
+        self.fp = StringIO.StringIO(data)
+        self.chunked = chunked
+
+
+class DocumentCacheTest(FakeCouchTestCase):
+    
+    def test_iter_lines_decodes_chunks(self):
+        # Lines split across chunks, a heartbeat, and a chunk extension.
+        data = ('5\r\n{"id"\r\n7;ext=1\r\n:"a"}\n\n\r\n'
+            'a\r\n{"id":"b"}\r\n1\r\n\n\r\n0\r\n\r\n')
+        self.assertEqual(list(doccache.iter_lines(FakeResponse(data, True))),
+            ['{"id":"a"}\n', '\n', '{"id":"b"}\n'])
+        self.assertEqual(list(doccache.iter_lines(FakeResponse('a\nb\n',
+            False))), ['a\n', 'b\n'])
+    
+    def test_unicode_ids_are_quoted(self):
+        self.server.dbs['db']['caf\xc3\xa9'] = {'_id': u'caf\xe9',
+            '_rev': '1-a'}
+        cache = doccache.DocumentCache(10)
+        self.assertEqual(cache.get(u'caf\xe9', 'db', self.server.url)['_id'],
+            u'caf\xe9')
+        for connection in cache.local.connections.values():
+            connection.close()
+    
+    def test_follower_evicts_changed_documents(self):
+        cache = doccache.DocumentCache(10)
+        url = self.server.url
+        # A long retry interval keeps the thread quiet once the server stops.
+        cache.follow('db', url, heartbeat=50, retry_interval=3600)
+        self.assert_(wait_for(lambda: (url.rstrip('/'), 'db') in
+            cache.followed))
+        self.assertEqual(cache.get('doc', 'db', url)['n'], 1)
+        self.put_doc('db', {'_id': 'doc', '_rev': '1-a', 'n': 2})
+        self.assert_(wait_for(lambda: (url.rstrip('/'), 'db', 'doc', None)
+            not in cache.entries))
+        self.assertEqual(cache.get('doc', 'db', url)['n'], 2)
+        for connection in cache.local.connections.values():
+            connection.close()
+
+
+class ReplicationTest(FakeCouchTestCase):
+    
+    def setUp(self):
+        FakeCouchTestCase.setUp(self)
+        self.get_server = shortcuts.get_server
+        shortcuts.get_server = lambda: shortcuts.pool.get_server(
+            self.server.url)
+    
+    def tearDown(self):
+        shortcuts.get_server = self.get_server
+        shortcuts.pool.clear()
+        FakeCouchTestCase.tearDown(self)
+    
+    def test_replicate_existing(self):
+        self.server.dbs['copy'] = {}
+        result = replicate.replicate_existing('local:db', 'local:copy')
+        self.assertEqual(result['docs_written'], 1)
+        self.assertEqual(self.server.dbs['copy'].keys(), ['doc'])
+    
+    def test_server_errors_raise_replication_error(self):
+        try:
+            replicate.replicate_existing('local:missing', 'local:db')
+        except replicate.ReplicationError, exc:
+            self.assertEqual(exc.response_status, 500)
+            self.assertEqual(exc.error, 'db_not_found')
+            self.assertEqual(exc.reason, 'could not open missing')
+        else:
+            self.fail('ReplicationError not raised.')
+
+
+class ServerPoolTest(FakeCouchTestCase):
+    
+    def test_clear_closes_connections(self):
+        pool = shortcuts.ServerPool()
+        server = pool.get_server(self.server.url)
+        self.assert_('db' in server)
+        connections = server.resource.http.connections.values()
+        self.assert_(connections)
+        pool.clear()
+        self.assertEqual(pool.entries, {})
+        for connection in connections:
+            self.assertEqual(connection.sock, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
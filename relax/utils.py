@@ -2,6 +2,10 @@
 
 import os
 import re
+try:
+    import threading
+except ImportError:
+    import dummy_threading as threading
 
 
 def generator_to_list(function):
@@ -41,7 +45,7 @@ def logrotate(filename):
     Return the next available filename for a particular filename prefix.
     
     For example:
-    
+        
         >>> import os
         # Make three (empty) files in a directory
         >>> fp0 = open('file.0', 'w')
@@ -60,7 +64,7 @@ def logrotate(filename):
     This can be used to get the next available filename for logging, allowing
     you to rotate log files, without using Python's ``logging`` module.
     """
-
+    
     match = re.match(r'(.*)' + re.escape(os.path.extsep) + r'(\d+)', filename)
     if os.path.exists(filename):
         if match:
@@ -71,4 +75,104 @@ def logrotate(filename):
             return os.path.extsep.join((prefix, str(number)))
     elif match:
         return filename
-    return logrotate(os.path.extsep.join((filename, '0')))
\ No newline at end of file
+    return logrotate(os.path.extsep.join((filename, '0')))
+
+
+class LRUCache(object):
+    
+    """
+    A bounded, thread-safe mapping which forgets its least recently used keys.
+    
+    For example:
+        
+        >>> cache = LRUCache(max_size=2)
+        >>> cache['a'] = 1
+        >>> cache['b'] = 2
+        >>> cache['a']
+        1
+        # Adding a third key pushes out 'b', which was used least recently.
+        >>> cache['c'] = 3
+        >>> 'b' in cache
+        False
+        >>> cache.get('b', 'missing')
+        'missing'
+    
+    A ``max_size`` of 0 (or less) turns the cache off: nothing is stored.
+    """
+    
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Maps keys to links in a circular, doubly-linked list which keeps the
+        # keys in order of use. Each link is [previous, next, key, value].
+        self.links = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+    
+    def __len__(self):
+        return len(self.links)
+    
+    def __contains__(self, key):
+        return key in self.links
+    
+    def __getitem__(self, key):
+        self.lock.acquire()
+        try:
+            link = self.links[key]
+            # Move the link to the most recently used end of the list.
+            link[0][1], link[1][0] = link[1], link[0]
+            last = self.root[0]
+            last[1] = self.root[0] = link
+            link[0], link[1] = last, self.root
+            return link[3]
+        finally:
+            self.lock.release()
+    
+    def __setitem__(self, key, value):
+        if self.max_size <= 0:
+            return
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key, None)
+            if link is not None:
+                link[0][1], link[1][0] = link[1], link[0]
+            elif len(self.links) >= self.max_size:
+                # Forget the least recently used key.
+                oldest = self.root[1]
+                oldest[0][1], oldest[1][0] = oldest[1], oldest[0]
+                del self.links[oldest[2]]
+            last = self.root[0]
+            link = [last, self.root, key, value]
+            last[1] = self.root[0] = self.links[key] = link
+        finally:
+            self.lock.release()
+    
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            link = self.links.pop(key)
+            link[0][1], link[1][0] = link[1], link[0]
+        finally:
+            self.lock.release()
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def pop(self, key, default=None):
+        try:
+            value = self[key]
+            del self[key]
+        except KeyError:
+            return default
+        return value
+    
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.links.clear()
+            self.root[:] = [self.root, self.root, None, None]
+        finally:
+            self.lock.release()
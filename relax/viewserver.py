@@ -1,16 +1,34 @@
 # -*- coding: utf-8 -*-
 
+import asynchat
+import asyncore
+import array
+import atexit
+import itertools
+import operator
 from os import linesep as NEWLINE
+import select
+import signal
+import socket
 import SocketServer
 import sys
+import time
 try:
     import threading
 except ImportError:
     import dummy_threading as threading
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import couchdb
 
-from relax import json, settings, utils
+from relax import codec, schema, settings, utils
 
 
 def get_function(function_name):
@@ -23,17 +41,15 @@ def get_function(function_name):
     except (ImportError, AttributeError):
         raise FunctionNotFound(function_name)
 
-def one_lineify(json_data):
-    """Prevent JSON data from taking up multiple lines."""
-    # simplejson replaces all newlines inside the data with '\\n' (i.e.
-    # backslash then n, instead of newline character), so we can safely assume
-    # that all newlines are in-between strings.
-    return json_data.replace('\n', ' ').replace('\r', ' ')
+def encode_line(data):
+    """Encode data as a single line of JSON output, including the newline."""
+    # ``relax.codec`` never puts newlines in its output.
+    return codec.dumps(data) + NEWLINE
 
 def js_error(exc):
     """Transform a Python exception into a CouchDB JSON error."""
     # This is the format in which CouchDB interprets errors.
-    return json.dumps({
+    return codec.dumps({
         'error': type(exc).__name__,
         'reason': str(exc)})
 
@@ -50,164 +66,951 @@ class FunctionNotFound(Exception):
         Exception.__init__(self, 'Function %r not found.' % (function_name,))
 
 
-class ViewServerRequestHandler(SocketServer.StreamRequestHandler):
+def builtin_count(keys, values, rereduce=False):
+    """Count the mapped rows (built-in ``_count`` reducer)."""
+    if rereduce:
+        return sum(values)
+    return len(values)
+
+def is_integer_column(values):
+    """Return whether a column of values holds nothing but integers."""
+    if isinstance(values, array.array):
+        return values.typecode == 'l'
+    return all(itertools.imap(isinstance, values,
+        itertools.repeat((int, long))))
+
+def builtin_sum(keys, values, rereduce=False):
+    """Sum the mapped values (built-in ``_sum`` reducer)."""
+    # ``sum`` already loops in C, and keeps integers exact.
+    if not values or not isinstance(values[0], (list, tuple)):
+        return sum(values)
+    # Arrays of numbers are summed element-wise. NumPy would turn integers
+    # into floats (or overflow them), so it's only used when there are floats.
+    if numpy is not None and not all(itertools.imap(is_integer_column,
+        values)):
+        try:
+            return numpy.array(values, dtype=float).sum(axis=0).tolist()
+        except ValueError:
+            # Ragged arrays; fall through to the pure-Python version.
+            pass
+    return map(sum, itertools.izip_longest(fillvalue=0, *values))
+
+def builtin_stats(keys, values, rereduce=False):
+    """Summary statistics of the mapped values (built-in ``_stats`` reducer)."""
+    if rereduce:
+        return {
+            'sum': sum(stats['sum'] for stats in values),
+            'count': sum(stats['count'] for stats in values),
+            'min': min(stats['min'] for stats in values),
+            'max': max(stats['max'] for stats in values),
+            'sumsqr': sum(stats['sumsqr'] for stats in values)}
+    if numpy is not None and not is_integer_column(values):
+        column = numpy.array(values, dtype=float)
+        return {
+            'sum': float(column.sum()), 'count': len(column),
+            'min': float(column.min()), 'max': float(column.max()),
+            'sumsqr': float(numpy.dot(column, column))}
+    # Python's own numbers; integers never lose precision or overflow.
+    return {
+        'sum': sum(values), 'count': len(values),
+        'min': min(values), 'max': max(values),
+        'sumsqr': sum(itertools.imap(operator.mul, values, values))}
+
+# Reducers which are available under well-known names, without needing to be
+# imported; they work on whole columns of values at once, rather than through
+# Python code run per row.
+BUILTIN_REDUCERS = {
+    '_count': builtin_count,
+    '_sum': builtin_sum,
+    '_stats': builtin_stats,
+}
+
+
+class FunctionStats(object):
+    
+    """
+    Call count, error count and timings for a single view function.
+    
+    Only the most recent ``sample_size`` call durations are kept for working
+    out percentiles, so memory use is bounded however many calls are made.
+    """
+    
+    sample_size = 1000
+    
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.samples = []
+        self.next_sample = 0
+    
+    def add(self, seconds, error=False):
+        self.calls += 1
+        self.seconds += seconds
+        if error:
+            self.errors += 1
+        if len(self.samples) < self.sample_size:
+            self.samples.append(seconds)
+        else:
+            self.samples[self.next_sample] = seconds
+            self.next_sample = (self.next_sample + 1) % self.sample_size
+    
+    def merge(self, calls, errors, seconds, samples):
+        """Add in the counts and samples from another process."""
+        self.calls += calls - len(samples)
+        self.errors += errors
+        self.seconds += seconds - sum(samples)
+        for sample in samples:
+            self.add(sample)
+    
+    def summary(self):
+        samples = sorted(self.samples)
+        def percentile(fraction):
+            if not samples:
+                return 0.0
+            return samples[int(round(fraction * (len(samples) - 1)))] * 1000
+        return {
+            'calls': self.calls, 'errors': self.errors,
+            'total_ms': self.seconds * 1000,
+            'mean_ms': self.calls and self.seconds * 1000 / self.calls or 0.0,
+            'p50_ms': percentile(0.5), 'p90_ms': percentile(0.9),
+            'p99_ms': percentile(0.99)}
+
+
+class ViewServerStats(object):
+    
+    """
+    Per-function statistics for every map, reduce, rereduce and validate call.
+    
+    Collection is off unless ``enabled`` is set (by default, from the
+    ``VIEW_SERVER_STATS`` setting), since it costs a couple of clock reads per
+    function call. When it's on, ``FunctionRegistry`` wraps each function it
+    resolves with ``timed``. Worker processes collect their own statistics,
+    and send them back (via ``take`` and ``merge``) with each task's results.
+    The report can be fetched with the ``stats`` protocol command, or dumped
+    to stderr on ``SIGUSR1`` (see ``install_signal_handler``).
+    """
     
-    functions = {}
-    function_counter = 0
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # Maps (kind, function_name) to ``FunctionStats``.
+        self.functions = {}
+        # A running ``SamplingProfiler``, if there is one.
+        self.profiler = None
+    
+    def record(self, kind, function_name, seconds, error=False):
+        self.lock.acquire()
+        try:
+            stats = self.functions.get((kind, function_name))
+            if stats is None:
+                stats = self.functions[(kind, function_name)] = FunctionStats()
+            stats.add(seconds, error)
+        finally:
+            self.lock.release()
+    
+    def timed(self, kind, function_name, function):
+        """Wrap a view function so that its calls are recorded."""
+        record = self.record
+        if kind == 'map':
+            def timed_function(document):
+                start, error = time.time(), True
+                try:
+                    # Generator functions do their work as they're consumed.
+                    result = list(function(document))
+                    error = False
+                    return result
+                finally:
+                    record('map', function_name, time.time() - start, error)
+        else:
+            def timed_function(keys, values, rereduce=False):
+                start, error = time.time(), True
+                try:
+                    result = function(keys, values, rereduce=rereduce)
+                    error = False
+                    return result
+                finally:
+                    record(rereduce and 'rereduce' or 'reduce', function_name,
+                        time.time() - start, error)
+        return timed_function
+    
+    def take(self):
+        """Return (and forget) the raw statistics, for sending to ``merge``."""
+        self.lock.acquire()
+        try:
+            functions, self.functions = self.functions, {}
+        finally:
+            self.lock.release()
+        return [(key, (stats.calls, stats.errors, stats.seconds,
+            stats.samples)) for (key, stats) in functions.items()]
+    
+    def merge(self, raw_stats):
+        """Merge in raw statistics from ``take`` (e.g. in another process)."""
+        self.lock.acquire()
+        try:
+            for key, raw in raw_stats:
+                stats = self.functions.get(key)
+                if stats is None:
+                    stats = self.functions[key] = FunctionStats()
+                stats.merge(*raw)
+        finally:
+            self.lock.release()
+    
+    def report(self):
+        """Return the statistics as ``{kind: {function_name: summary}}``."""
+        self.lock.acquire()
+        try:
+            report = {}
+            for (kind, function_name), stats in self.functions.items():
+                report.setdefault(kind, {})[function_name] = stats.summary()
+        finally:
+            self.lock.release()
+        if self.profiler is not None:
+            report['profile'] = self.profiler.report()
+        return report
+    
+    def dump(self, stream):
+        """Write the report to a stream, slowest functions first."""
+        report = self.report()
+        for kind in ('map', 'reduce', 'rereduce', 'validate'):
+            functions = report.get(kind, {})
+            ranked = sorted(functions.items(),
+                key=lambda item: -item[1]['total_ms'])
+            for function_name, summary in ranked:
+                stream.write('%-8s %-40s %8d calls %6d errors %10.1fms total '
+                    '%8.3fms p50 %8.3fms p99\n' % (kind, function_name,
+                        summary['calls'], summary['errors'],
+                        summary['total_ms'], summary['p50_ms'],
+                        summary['p99_ms']))
+        for count, location in report.get('profile', []):
+            stream.write('profile  %-40s %8d samples\n' % (location, count))
+        stream.flush()
+
+
+class SamplingProfiler(object):
+    
+    """
+    A statistical profiler which periodically samples every thread's stack.
+    
+    Every ``interval`` seconds, the innermost frame of each other thread is
+    recorded; ``report`` gives the most frequently-seen locations, which is
+    where the time is going. Unlike ``cProfile``, the overhead doesn't grow
+    with the number of function calls, so it's cheap enough to leave running
+    against production traffic. Only the current process is sampled.
+    """
+    
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.running = False
+        self.thread = None
+    
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        # Stop sampling before the interpreter starts tearing itself down.
+        atexit.register(self.stop)
+    
+    def stop(self):
+        self.running = False
+    
+    def run(self):
+        own_id = self.thread.ident
+        while self.running:
+            time.sleep(self.interval)
+            self.lock.acquire()
+            try:
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own_id:
+                        continue
+                    code = frame.f_code
+                    location = '%s:%d(%s)' % (code.co_filename,
+                        frame.f_lineno, code.co_name)
+                    self.counts[location] = self.counts.get(location, 0) + 1
+            finally:
+                self.lock.release()
+    
+    def report(self, limit=20):
+        """Return the ``limit`` most-sampled ``(count, location)`` pairs."""
+        self.lock.acquire()
+        try:
+            ranked = sorted(((count, location)
+                for (location, count) in self.counts.items()), reverse=True)
+        finally:
+            self.lock.release()
+        return ranked[:limit]
+
+
+stats = ViewServerStats(settings._('VIEW_SERVER_STATS', False))
+
+def install_signal_handler(signum=getattr(signal, 'SIGUSR1', None),
+    stream=sys.stderr):
+    """Dump the statistics to ``stream`` whenever a signal is received."""
+    if signum is None:
+        # No such signal on this platform.
+        return
+    signal.signal(signum, lambda signum, frame: stats.dump(stream))
+    # Restart interrupted reads, rather than failing them; the dump happens
+    # as soon as the main thread is next running Python code.
+    signal.siginterrupt(signum, False)
+
+
+class FunctionRegistry(object):
+    
+    """
+    A registry of resolved view functions.
+    
+    Map functions are resolved once, when they are added, and kept in a list in
+    order of addition; this list *is* the map pipeline, so mapping a document
+    is just a matter of iterating over it. Reduce functions are resolved on
+    first use and memoized by name, so repeated reductions don't have to go
+    through ``get_function`` (and the ``view_decorated`` wrapping) every time.
+    Validators are memoized in the same way, so a write doesn't have to import
+    its validator; a name which refers to a dictionary rather than a function
+    is taken to be a declarative schema (see ``relax.schema``), and compiled
+    into a validator once, when first used.
+    """
+    
+    def __init__(self, log):
+        self.log = log
+        self.map_functions = []
+        self.reduce_functions = {}
+        self.validators = {}
+    
+    def resolve(self, function_name, kind=None):
+        """Return the callable for a function name, decorating if necessary."""
+        if function_name in BUILTIN_REDUCERS:
+            function = BUILTIN_REDUCERS[function_name]
+        else:
+            function = get_function(function_name)
+            # This tests to see if the function has been decorated with the
+            # view server synchronisation decorator (``decorate_view``). If
+            # so, the decorator gets called with the logger function.
+            if getattr(function, 'view_decorated', None):
+                function = function(self.log)
+        if kind is not None and stats.enabled:
+            function = stats.timed(kind, function_name, function)
+        return function
+    
+    def reset(self):
+        """Clear the map pipeline."""
+        self.map_functions = []
+    
+    def add_map(self, function_name):
+        """Resolve a map function and append it to the map pipeline."""
+        self.map_functions.append(
+            self.resolve(function_name.strip(), kind='map'))
+    
+    def get_reduce(self, function_name):
+        """Return the (memoized) reduce function for a name."""
+        try:
+            return self.reduce_functions[function_name]
+        except KeyError:
+            function = self.resolve(function_name, kind='reduce')
+            self.reduce_functions[function_name] = function
+            return function
+    
+    def get_reduces(self, function_names):
+        """Return a list of reduce functions; failures become no-ops."""
+        reduce_functions = []
+        for function_name in function_names:
+            try:
+                reduce_functions.append(self.get_reduce(function_name))
+            except Exception, exc:
+                self.log(repr(exc))
+                reduce_functions.append(lambda *args, **kwargs: None)
+        return reduce_functions
+    
+    def get_validator(self, function_name):
+        """Return the (memoized) validator for a name, compiling schemas."""
+        try:
+            return self.validators[function_name]
+        except KeyError:
+            validator = self.resolve(function_name)
+            if isinstance(validator, dict):
+                validator = schema.compile_schema(validator)
+            self.validators[function_name] = validator
+            return validator
+
+
+class KeyColumn(object):
+    
+    """
+    A read-only sequence of the keys of some map output rows.
+    
+    CouchDB sends the input to ``reduce`` as rows of ``[[key, doc_id],
+    value]``. This presents their keys as a sequence without copying them
+    out, so reduce functions which never look at their keys (like the
+    built-in ones) cost nothing extra for them.
+    """
+    
+    __slots__ = ('rows',)
+    
+    def __init__(self, rows):
+        self.rows = rows
+    
+    def __len__(self):
+        return len(self.rows)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [row[0][0] for row in self.rows[index]]
+        return self.rows[index][0][0]
+    
+    def __iter__(self):
+        for row in self.rows:
+            yield row[0][0]
+    
+    def __repr__(self):
+        return 'KeyColumn(%r)' % (list(self),)
+    
+    def __reduce__(self):
+        # Only the keys are pickled (e.g. when sent to a worker process).
+        return (list, (list(self),))
+
+def value_column(rows, numeric=False):
+    
+    """
+    Return the values of some map output rows, as a compact sequence.
+    
+    If ``numeric`` is true and every value is a machine-sized integer, they're
+    packed into an ``array.array`` of them, which takes a third of the memory
+    of a list of number objects; likewise, values including floats are packed
+    into an array of doubles. Otherwise (if some integers are too big to fit,
+    or some values aren't numbers) a list is returned, so integers stay exact.
+    Only the built-in reducers are guaranteed not to care which they get.
+    """
+    
+    if numeric:
+        try:
+            return array.array('l', (row[1] for row in rows))
+        except OverflowError:
+            # Integers beyond a machine long; doubles would round them.
+            return [row[1] for row in rows]
+        except TypeError:
+            # Some values aren't integers.
+            pass
+        try:
+            return array.array('d', (row[1] for row in rows))
+        except TypeError:
+            pass
+    return [row[1] for row in rows]
+
+def map_document(map_functions, document, log):
+    """Return the mapping of a document by each of a list of map functions."""
+    results = []
+    for function in map_functions:
+        try:
+            # It has to be run through ``list``, because it may be a generator
+            # function.
+            results.append([list(function(document))])
+        except Exception, exc:
+            # Otherwise, return an empty list and log the event.
+            results.append([])
+            log(repr(exc))
+    return results
+
+def reduce_values(reduce_functions, keys, values, rereduce, log):
+    """Return the results of several reduce functions over some values."""
+    results = []
+    for reduce_function in reduce_functions:
+        try:
+            results.append(reduce_function(keys, values, rereduce=rereduce))
+        except Exception, exc:
+            log(repr(exc))
+            results.append(None)
+    return results
+
+def validate_document(registry, function_name, new_doc, old_doc, user_ctx,
+    log):
+    """Return the result of a validator, or the error it raised."""
+    try:
+        validator = registry.get_validator(function_name)
+    except Exception, exc:
+        log(repr(exc))
+        return False
+    start, error = time.time(), True
+    try:
+        result = validator(new_doc, old_doc, user_ctx)
+        error = False
+        return result
+    except Exception, exc:
+        log(repr(exc))
+        return repr(exc)
+    finally:
+        if stats.enabled:
+            stats.record('validate', function_name, time.time() - start,
+                error)
+
+
+# Each worker process in the process pool holds its own copy of the registered
+# functions. Registries are keyed by the tuple of map function names, so a
+# worker only has to resolve a given set of functions once; log messages (and
+# statistics, if enabled) are collected while a task runs and shipped back with
+# its output.
+_worker_log = []
+_worker_registries = {}
+
+def _worker_init():
+    # Forget any statistics inherited from the parent process, so they aren't
+    # sent back and counted twice.
+    stats.take()
+    stats.profiler = None
+
+def _worker_registry(map_function_names):
+    registry = _worker_registries.get(map_function_names)
+    if registry is None:
+        if len(_worker_registries) >= 64:
+            _worker_registries.clear()
+        registry = FunctionRegistry(_worker_log.append)
+        for function_name in map_function_names:
+            registry.add_map(function_name)
+        _worker_registries[map_function_names] = registry
+    return registry
+
+def _worker_map_docs((map_function_names, documents)):
+    """Map a chunk of documents in a worker, returning output and stats."""
+    registry = _worker_registry(map_function_names)
+    output = []
+    for document in documents:
+        del _worker_log[:]
+        result = map_document(registry.map_functions, document,
+            _worker_log.append)
+        output.extend(encode_line({'log': string}) for string in _worker_log)
+        output.append(encode_line(result))
+    return ''.join(output), stats.take()
+
+def _worker_reduce((reduce_function_names, keys, values, rereduce)):
+    """Reduce some values in a worker, returning the results, log and stats."""
+    del _worker_log[:]
+    registry = _worker_registry(())
+    results = reduce_values(registry.get_reduces(reduce_function_names),
+        keys, values, rereduce, _worker_log.append)
+    return results, list(_worker_log), stats.take()
+
+def _worker_validate((function_name, new_doc, old_doc, user_ctx)):
+    """Validate a document in a worker, returning the result, log and stats."""
+    del _worker_log[:]
+    result = validate_document(_worker_registry(()), function_name, new_doc,
+        old_doc, user_ctx, _worker_log.append)
+    return result, list(_worker_log), stats.take()
+
+
+class ViewServerProtocol(object):
+    
+    """
+    The view server's command protocol, independent of any transport.
+    
+    CouchDB talks to a view server by sending it lines of JSON, each of which
+    is a command (``reset``, ``add_fun``, ``map_doc``, ``reduce``, ``rereduce``
+    or ``validate``) followed by its arguments. An instance of this class holds
+    the state of one such conversation; lines are fed in with ``handle_lines``
+    and the resulting output (including log messages, in order) is retrieved
+    with ``take_output``. The drivers below run it over TCP or Unix sockets
+    (threaded or ``asyncore``-based), or over stdin/stdout.
+    
+    There is one extra command, ``stats``, which CouchDB never sends; it
+    returns the statistics collected by ``stats`` (see ``ViewServerStats``),
+    plus whether collection is ``enabled``, so they can be fetched by
+    connecting to a running server and sending ``["stats"]``.
+    """
+    
+    def __init__(self, pool=None, processes=0):
+        # Output waiting to be written back to CouchDB.
+        self.output = []
+        # Each conversation gets its own set of functions.
+        self.functions = FunctionRegistry(self.log)
+        # The names of the map functions, in order, for the worker processes.
+        self.map_function_names = []
+        # The process pool to ship work off to, or ``None`` to run inline.
+        self.pool = pool
+        self.processes = processes
+        # Validators are usually cheap enough that shipping the documents to a
+        # worker costs more than it saves, so they run inline unless asked.
+        self.validate_in_pool = settings._('VIEW_SERVER_VALIDATE_IN_POOL',
+            False)
     
     def handle_reset(self):
         """Reset the current function list."""
-        self.functions.clear()
-        self.function_counter = 0
+        self.functions.reset()
+        self.map_function_names = []
+        # CouchDB waits for an acknowledgement before sending anything else.
+        return True
     
     def handle_add_fun(self, function_name):
         """Add a function to the function list, in order."""
-        function_name = function_name.strip()
         try:
-            function = get_function(function_name)
+            self.functions.add_map(function_name)
         except Exception, exc:
-            self.wfile.write(js_error(exc) + NEWLINE)
+            self.output.append(js_error(exc) + NEWLINE)
             return
-        # This tests to see if the function has been decorated with the view
-        # server synchronisation decorator (``decorate_view``).
-        if not getattr(function, 'view_decorated', None):
-            self.functions[function_name] = (self.function_counter, function)
-        # The decorator gets called with the logger function.
-        else:
-            self.functions[function_name] = (self.function_counter,
-                function(self.log))
-        self.function_counter += 1
+        self.map_function_names.append(function_name.strip())
         return True
     
-    @utils.generator_to_list
     def handle_map_doc(self, document):
         """Return the mapping of a document according to the function list."""
-        # This uses the stored set of functions, sorted by order of addition.
-        for function in sorted(self.functions.values(), key=lambda x: x[0]):
-            try:
-                # It has to be run through ``list``, because it may be a
-                # generator function.
-                yield [list(function(document))]
-            except Exception, exc:
-                # Otherwise, return an empty list and log the event.
-                yield []
-                self.log(repr(exc))
+        # The map pipeline is already in order of addition.
+        return map_document(self.functions.map_functions, document, self.log)
     
     def handle_reduce(self, reduce_function_names, mapped_docs):
         """Reduce several mapped documents by several reduction functions."""
-        reduce_functions = []
-        # This gets a large list of reduction functions, given their names.
-        for reduce_function_name in reduce_function_names:
-            try:
-                reduce_function = get_function(reduce_function_name)
-                if getattr(reduce_function, 'view_decorated', None):
-                    reduce_function = reduce_function(self.log)
-                reduce_functions.append(reduce_function)
-            except Exception, exc:
-                self.log(repr(exc))
-                reduce_functions.append(lambda *args, **kwargs: None)
-        # Transform lots of (key, value) pairs into one (keys, values) pair.
-        keys, values = zip(
-            (key, value) for ((key, doc_id), value) in mapped_docs)
-        # This gets the list of results from the reduction functions.
-        results = []
-        for reduce_function in reduce_functions:
-            try:
-                results.append(reduce_function(keys, values, rereduce=False))
-            except Exception, exc:
-                self.log(repr(exc))
-                results.append(None)
-        return [True, results]
+        # Split the rows into a column of keys and a column of values, without
+        # building a tuple per row.
+        numeric = not [function_name for function_name in reduce_function_names
+            if function_name not in BUILTIN_REDUCERS]
+        keys = KeyColumn(mapped_docs)
+        values = value_column(mapped_docs, numeric=numeric)
+        return [True, self.reduce(reduce_function_names, keys, values, False)]
     
     def handle_rereduce(self, reduce_function_names, values):
         """Re-reduce a set of values, with a list of rereduction functions."""
-        # This gets a large list of reduction functions, given their names.
-        reduce_functions = []
-        for reduce_function_name in reduce_function_names:
-            try:
-                reduce_function = get_function(reduce_function_name)
-                if getattr(reduce_function, 'view_decorated', None):
-                    reduce_function = reduce_function(self.log)
-                reduce_functions.append(reduce_function)
-            except Exception, exc:
-                self.log(repr(exc))
-                reduce_functions.append(lambda *args, **kwargs: None)
-        # This gets the list of results from those functions.
-        results = []
-        for reduce_function in reduce_functions:
-            try:
-                results.append(reduce_function(None, values, rereduce=True))
-            except Exception, exc:
-                self.log(repr(exc))
-                results.append(None)
-        return [True, results]
+        return [True, self.reduce(reduce_function_names, None, values, True)]
+    
+    def reduce(self, reduce_function_names, keys, values, rereduce):
+        """Run some reduce functions, in a worker process if there's a pool."""
+        if self.pool is None:
+            return reduce_values(
+                self.functions.get_reduces(reduce_function_names),
+                keys, values, rereduce, self.log)
+        results, log, raw_stats = self.pool.apply(_worker_reduce,
+            ((tuple(reduce_function_names), keys, values, rereduce),))
+        stats.merge(raw_stats)
+        for string in log:
+            self.log(string)
+        return results
     
     def handle_validate(self, function_name, new_doc, old_doc, user_ctx):
         """Validate...this function is undocumented, but still in CouchDB."""
-        try:
-            function = get_function(function_name)
-        except Exception, exc:
-            self.log(repr(exc))
-            return False
-        try:
-            return function(new_doc, old_doc, user_ctx)
-        except Exception, exc:
-            self.log(repr(exc))
-            return repr(exc)
+        if self.pool is None or not self.validate_in_pool:
+            return validate_document(self.functions, function_name, new_doc,
+                old_doc, user_ctx, self.log)
+        result, log, raw_stats = self.pool.apply(_worker_validate,
+            ((function_name, new_doc, old_doc, user_ctx),))
+        stats.merge(raw_stats)
+        for string in log:
+            self.log(string)
+        return result
     
-    def handle(self):
-        """The main function called to handle a request."""
-        while True:
+    def handle_stats(self):
+        """Return the view server's statistics (not a CouchDB command)."""
+        # There's always a reply, even with nothing recorded; an empty report
+        # would write no line at all, leaving the client waiting for one.
+        return dict(stats.report(), enabled=stats.enabled)
+    
+    def handle_command(self, cmd):
+        """Dispatch a single decoded command, queueing its output."""
+        # Automagically get the command handler.
+        handler = getattr(self, 'handle_' + cmd[0], None)
+        if not handler:
+            # We are ready to not find commands. It probably won't happen, but
+            # fortune favours the prepared.
+            self.output.append(repr(CommandNotFound(cmd[0])) + NEWLINE)
+            return
+        return_value = handler(*cmd[1:])
+        if return_value:
+            self.output.append(encode_line(return_value))
+    
+    def handle_map_batch(self, documents):
+        """Map a run of documents, queueing one line of output per document."""
+        if self.pool is None:
+            for document in documents:
+                self.output.append(encode_line(self.handle_map_doc(document)))
+            return
+        # Split the documents into one chunk per worker; ``Pool.map`` gives
+        # the results back in the same order.
+        chunk_size = -(-len(documents) // self.processes)
+        map_function_names = tuple(self.map_function_names)
+        for output, raw_stats in self.pool.map(_worker_map_docs,
+            [(map_function_names, documents[i:i + chunk_size])
+             for i in xrange(0, len(documents), chunk_size)]):
+            self.output.append(output)
+            stats.merge(raw_stats)
+    
+    def handle_lines(self, lines):
+        """Dispatch several lines of input, in order."""
+        # Consecutive ``map_doc`` commands are gathered up and mapped as a
+        # batch; anything else flushes the batch first, so the output is
+        # always in the same order as the input.
+        documents = []
+        for line in lines:
             try:
-                line = self.rfile.readline()
-                try:
-                    # All input data are lines of JSON like the following:
-                    #   ["<cmd_name>" "<cmd_arg1>" "<cmd_arg2>" ...]
-                    # So I handle this by dispatching to various methods.
-                    cmd = json.loads(line)
-                except Exception, exc:
+                # All input data are lines of JSON like the following:
+                #   ["<cmd_name>" "<cmd_arg1>" "<cmd_arg2>" ...]
+                # So I handle this by dispatching to various methods.
+                cmd, error = codec.loads(line), None
+            except Exception, exc:
+                cmd, error = None, exc
+            if error is None and not (isinstance(cmd, list) and cmd):
+                error = ValueError('Commands must be non-empty lists: %r' % (
+                    cmd,))
+            if error is None and cmd[0] == 'map_doc' and len(cmd) == 2:
+                documents.append(cmd[1])
+                continue
+            try:
+                if documents:
+                    self.handle_map_batch(documents)
+                    documents = []
+                if error is not None:
                     # Sometimes errors come up. Once again, I can't predict
                     # anything, but can at least tell CouchDB about the error.
-                    self.wfile.write(repr(exc) + NEWLINE)
-                    continue
+                    self.output.append(repr(error) + NEWLINE)
                 else:
-                    # Automagically get the command handler.
-                    handler = getattr(self, 'handle_' + cmd[0], None)
-                    if not handler:
-                        # We are ready to not find commands. It probably won't
-                        # happen, but fortune favours the prepared.
-                        self.wfile.write(
-                            repr(CommandNotFound(cmd[0])) + NEWLINE)
-                        continue
-                    return_value = handler(*cmd[1:])
-                    if not return_value:
-                        continue
-                    # We write the output back to CouchDB.
-                    self.wfile.write(
-                        one_lineify(json.dumps(return_value)) + NEWLINE)
+                    self.handle_command(cmd)
             except Exception, exc:
-                self.wfile.write(repr(exc) + NEWLINE)
-                continue
+                self.output.append(repr(exc) + NEWLINE)
+        if documents:
+            try:
+                self.handle_map_batch(documents)
+            except Exception, exc:
+                self.output.append(repr(exc) + NEWLINE)
     
     def log(self, string):
         """Log an event on the CouchDB server."""
-        self.wfile.write(json.dumps({'log': string}) + NEWLINE)
+        self.output.append(encode_line({'log': string}))
+    
+    def take_output(self):
+        """Return (and forget) all output queued so far, as one string."""
+        output, self.output = ''.join(self.output), []
+        return output
+
+
+def input_pending(rfile):
+    """Return whether another line of input is already waiting on a file."""
+    # Data which the file object has already pulled off the socket.
+    buffered = getattr(rfile, '_rbuf', None)
+    if buffered is not None:
+        if not isinstance(buffered, basestring):
+            buffered = buffered.getvalue()
+        if '\n' in buffered:
+            return True
+    # Data sitting in the kernel's buffer.
+    readable, writable, errors = select.select([rfile], [], [], 0)
+    return bool(readable)
+
+def read_batch(rfile, batch_size):
+    """Read a line, plus as many more as can be read without waiting."""
+    # CouchDB normally waits for each response before sending the next line,
+    # so this never blocks waiting for a batch to fill up.
+    lines = [rfile.readline()]
+    while lines[-1] and len(lines) < batch_size and input_pending(rfile):
+        lines.append(rfile.readline())
+    return lines
+
+def serve_stream(protocol, rfile, wfile, batch_size):
+    """Run the view server protocol over a pair of file objects until EOF."""
+    while True:
+        lines = read_batch(rfile, batch_size)
+        # An empty string means the other end has hung up.
+        at_eof = not lines[-1]
+        if at_eof:
+            lines.pop()
+        try:
+            protocol.handle_lines(lines)
+        finally:
+            # All the responses to a batch go back in a single write.
+            output = protocol.take_output()
+            if output:
+                wfile.write(output)
+                wfile.flush()
+        if at_eof:
+            return
+
+def make_pool(processes=None):
+    """Return a ``(processes, pool)`` pair for a number of worker processes."""
+    if processes is None:
+        processes = settings._('VIEW_SERVER_PROCESSES', 0)
+    if not processes:
+        return 0, None
+    if multiprocessing is None:
+        raise ImportError(
+            'The multiprocessing module is required for a process pool.')
+    return processes, multiprocessing.Pool(processes, _worker_init)
+
+
+class ViewServerRequestHandler(SocketServer.StreamRequestHandler):
+    
+    # The maximum number of lines which will be read ahead and handled in one
+    # go; their responses are sent back in a single write.
+    batch_size = settings._('VIEW_SERVER_BATCH_SIZE', 100)
+    
+    def handle(self):
+        """The main function called to handle a request."""
+        protocol = ViewServerProtocol(getattr(self.server, 'pool', None),
+            getattr(self.server, 'processes', 0))
+        serve_stream(protocol, self.rfile, self.wfile, self.batch_size)
+
+
+class ViewServerMixin:
+    
+    """
+    A socket server mixin which gives the server an optional process pool.
+    
+    By default, every connection's map and reduce functions run in that
+    connection's thread, and so all share a single core. If ``processes`` (or
+    the ``VIEW_SERVER_PROCESSES`` setting) is a positive number, a pool of that
+    many worker processes is started, and map/reduce work is shipped off to it
+    instead (as is validation, if ``VIEW_SERVER_VALIDATE_IN_POOL`` is set).
+    Subclasses set ``base_class`` to the socket server they extend.
+    """
+    
+    base_class = None
+    
+    def __init__(self, server_address, RequestHandlerClass, processes=None):
+        self.base_class.__init__(self, server_address, RequestHandlerClass)
+        self.processes, self.pool = make_pool(processes)
+    
+    def server_close(self):
+        self.base_class.server_close(self)
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
 
 
-class ViewServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    pass # I don't think this actually requires any code. I may be wrong.
+class ViewServer(ViewServerMixin, SocketServer.ThreadingMixIn,
+    SocketServer.TCPServer):
+    
+    base_class = SocketServer.TCPServer
 
 
-def main(host=settings._('VIEW_SERVER_HOST')):
-    host, port = host.split(':') # Should be in format 127.0.0.1:5936
-    port = int(port)
-    server = ViewServer((host, port), ViewServerRequestHandler)
+if hasattr(SocketServer, 'UnixStreamServer'):
+    class UnixViewServer(ViewServerMixin, SocketServer.ThreadingMixIn,
+        SocketServer.UnixStreamServer):
+        
+        base_class = SocketServer.UnixStreamServer
+
+
+class AsyncViewServerChannel(asynchat.async_chat):
+    
+    """
+    An ``asyncore`` channel which speaks the view server protocol.
+    
+    All of the lines which arrive in a single read are handled as one batch,
+    and their responses are pushed back together.
+    """
+    
+    def __init__(self, sock, pool=None, processes=0, map=None):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.set_terminator('\n')
+        self.protocol = ViewServerProtocol(pool, processes)
+        self.incoming = []
+        self.lines = []
+    
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+    
+    def found_terminator(self):
+        self.lines.append(''.join(self.incoming))
+        self.incoming = []
+    
+    def handle_read(self):
+        asynchat.async_chat.handle_read(self)
+        if self.lines:
+            lines, self.lines = self.lines, []
+            self.protocol.handle_lines(lines)
+            self.push(self.protocol.take_output())
+
+
+class AsyncViewServer(asyncore.dispatcher):
+    
+    """
+    A single-threaded, event-driven view server.
+    
+    Rather than a thread per connection, every connection is multiplexed onto
+    one ``asyncore`` loop; this copes much better with lots of CouchDB nodes
+    pointing at the same view server. ``family`` may be ``socket.AF_UNIX`` to
+    listen on a Unix socket instead of TCP.
+    """
+    
+    def __init__(self, server_address, family=socket.AF_INET, processes=None,
+        map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.channel_map = map
+        self.create_socket(family, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(server_address)
+        self.listen(socket.SOMAXCONN)
+        self.processes, self.pool = make_pool(processes)
+    
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, address = pair
+        AsyncViewServerChannel(sock, self.pool, self.processes,
+            map=self.channel_map)
+    
+    def serve_forever(self):
+        asyncore.loop(map=self.channel_map)
+    
+    def server_close(self):
+        self.close()
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+
+def serve_stdio(processes=None):
+    """Run the view server over stdin/stdout, as spawned by CouchDB itself."""
+    processes, pool = make_pool(processes)
+    if stats.enabled:
+        # There's no way to send the ``stats`` command over stdin, since it
+        # belongs to CouchDB.
+        install_signal_handler()
+    try:
+        serve_stream(ViewServerProtocol(pool, processes), sys.stdin,
+            sys.stdout, ViewServerRequestHandler.batch_size)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def main(host=None, processes=settings._('VIEW_SERVER_PROCESSES', 0),
+    use_async=settings._('VIEW_SERVER_ASYNC', False),
+    collect_stats=settings._('VIEW_SERVER_STATS', False),
+    profile=settings._('VIEW_SERVER_PROFILE', 0)):
+    # ``host`` should be in one of the following formats:
+    #   127.0.0.1:5936       Listen on a TCP port.
+    #   unix:/path/to/sock   Listen on a Unix socket.
+    #   stdio                Talk over stdin/stdout (as a CouchDB query server).
+    # It's looked up here, rather than as the default, so that this module can
+    # be imported (e.g. by the benchmarks) without the setting.
+    if host is None:
+        host = settings._('VIEW_SERVER_HOST')
+    # ``profile`` is the sampling interval of the profiler, in seconds; it's
+    # off if zero.
+    stats.enabled = collect_stats or bool(profile)
+    if profile:
+        stats.profiler = SamplingProfiler(profile)
+        stats.profiler.start()
+    if host == 'stdio':
+        return serve_stdio(processes=processes)
+    if host.startswith('unix:'):
+        family, address = socket.AF_UNIX, host[len('unix:'):]
+        description = 'View server running at %s' % (address,)
+    else:
+        hostname, port = host.split(':')
+        family, address = socket.AF_INET, (hostname, int(port))
+        description = 'View server running at %s on port %s' % address
+    if use_async:
+        server = AsyncViewServer(address, family=family, processes=processes)
+    elif family == socket.AF_UNIX:
+        server = UnixViewServer(address, ViewServerRequestHandler,
+            processes=processes)
+    else:
+        server = ViewServer(address, ViewServerRequestHandler,
+            processes=processes)
     server_thread = threading.Thread(target=server.serve_forever)
     server_thread.start()
-    print 'View server running at %s on port %s' % (host, port)
+    print description
 
 if __name__ == '__main__':
     try:
-        main()
+        if len(sys.argv) > 1:
+            main(sys.argv[1])
+        else:
+            main()
     except KeyboardInterrupt:
-        sys.exit(0)
\ No newline at end of file
+        sys.exit(0)